@@ -0,0 +1,57 @@
+"""
+Результаты NLP-анализа одной реплики, общие для всех компонентов бота.
+
+Одна и та же реплика токенизируется детектором модальности, при смене грамматического лица,
+при проверках ответных реплик, размечается частеречным теггером и парсится для правил и поиска имен.
+AnalyzedText создается один раз для каждой строки (см. TextUtils.analyze) и выполняет каждый вид
+анализа только при первом обращении. Результаты не модифицируются потребителями.
+"""
+
+# Части речи знаменательных слов, леммы которых попадают в get_lemma_set
+CONTENT_UPOS = ('VERB', 'ADJ', 'ADV', 'NOUN', 'PROPN')
+
+
+class AnalyzedText(object):
+    def __init__(self, text, text_utils):
+        self.text = text
+        self.text_utils = text_utils
+        self.tokens = None
+        self.clauses = None
+        self.tags = None
+        self.parsings = None
+        self.lemma_set = None
+
+    def __repr__(self):
+        return self.text
+
+    def get_text(self):
+        return self.text
+
+    def get_tokens(self):
+        """Кортеж токенов, как в TextUtils.tokenize"""
+        if self.tokens is None:
+            self.tokens = tuple(self.text_utils.tokenize(self.text))
+        return self.tokens
+
+    def get_clauses(self):
+        if self.clauses is None:
+            self.clauses = tuple(self.text_utils.split_clauses(self.text))
+        return self.clauses
+
+    def get_tags(self):
+        """Результаты частеречной разметки токенов - кортеж пар (слово, теги)"""
+        if self.tags is None:
+            self.tags = tuple(self.text_utils.tag(list(self.get_tokens())))
+        return self.tags
+
+    def get_parsings(self):
+        """Разбор UDPipe без синтаксиса: токены с леммами и морфологическими признаками"""
+        if self.parsings is None:
+            self.parsings = self.text_utils.parser.parse_text(self.text, need_syntax=False)
+        return self.parsings
+
+    def get_lemma_set(self):
+        """Множество лемм знаменательных слов (см. CONTENT_UPOS) по результатам get_parsings"""
+        if self.lemma_set is None:
+            self.lemma_set = frozenset(t.lemma for parsing in self.get_parsings() for t in parsing if t.upos in CONTENT_UPOS)
+        return self.lemma_set
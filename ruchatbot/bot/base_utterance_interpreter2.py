@@ -4,6 +4,9 @@
 
 12.01.2021 Добавляем работу с репликами в уважительной форме 2л мн.ч "как Вас зовут?"
 03.10.2021 Удаляем пробелы перед некоторыми знаками пунктуации
+19.10.2026 Таблицы смены лица объединяются при загрузке в один словарь, исправления предлогов делаются одним
+           скомпилированным регулярным выражением, результаты для целых фраз кэшируются.
+19.10.2026 Сверка с прежней реализацией смены лица запускается без файлов моделей, на встроенных таблицах.
 """
 
 import os
@@ -12,20 +15,44 @@ import logging
 import pickle
 
 from ruchatbot.bot.base_utterance_interpreter import BaseUtteranceInterpreter
+from ruchatbot.utils.lru_cache import LruCache
+
+
+# Исправления предлогов после смены лица: "ко тебе" => "к тебе", "к мне" => "ко мне" и т.д.
+PREPOSITION_FIXES = {'ко тебе': 'к тебе',
+                     'обо тебе': 'о тебе',
+                     'со тобой': 'с тобой',
+                     'во тебе': 'в тебе',
+
+                     'к мне': 'ко мне',
+                     'о мне': 'обо мне',
+                     'с мной': 'со мной',
+                     'в мне': 'во мне',
+                     }
+
+PREPOSITION_FIXES_RX = re.compile(r'\b(' + '|'.join(re.escape(s) for s in PREPOSITION_FIXES.keys()) + r')\b')
 
 
 class BaseUtteranceInterpreter2(BaseUtteranceInterpreter):
     def __init__(self):
         super(BaseUtteranceInterpreter2, self).__init__()
         self.logger = logging.getLogger('BaseUtteranceInterpreter2')
+        self.flip_cache = LruCache(max_size=20000)  # фраза => фраза со смененным лицом
+        self.normalize_cache = LruCache(max_size=20000)  # фраза => результат normalize_person
 
     def load(self, models_folder):
         self.logger.info('Loading BaseUtteranceInterpreter2 model files')
 
         # Таблицы для трансляции грамматического лица
         with open(os.path.join(models_folder, 'person_change_dictionary.pickle'), 'rb') as f:
-            self.person_changing_data = pickle.load(f)
-
+            self.init_person_tables(pickle.load(f))
+
+    def init_person_tables(self, person_changing_data):
+        """
+        Подготовка таблиц смены лица. person_changing_data - содержимое person_change_dictionary.pickle,
+        словарь с таблицами person_change_1s_2s, person_change_2s_1s и person_change_2p_1s.
+        """
+        self.person_changing_data = person_changing_data
         self.person_change_1s_2s = self.person_changing_data['person_change_1s_2s']
         self.person_change_2s_1s = self.person_changing_data['person_change_2s_1s']
         self.person_change_2p_1s = self.person_changing_data['person_change_2p_1s']
@@ -79,52 +106,128 @@ class BaseUtteranceInterpreter2(BaseUtteranceInterpreter):
                                   'наш': 'ваш',
                                   }
 
+        # Объединенная таблица замен. Таблицы перечислены в порядке убывания приоритета,
+        # при совпадении слов в нескольких таблицах остается замена из более приоритетной.
+        self.person_flip_table = dict()
+        for table in [self.hard_replacement,
+                      self.person_change_1s_2s,
+                      self.person_change_2s_1s,
+                      self.person_change_2p_1s,
+                      self.special_changes_3]:
+            for word, new_word in table.items():
+                if word not in self.person_flip_table:
+                    self.person_flip_table[word] = new_word
+
+        self.flip_cache.clear()
+        self.normalize_cache.clear()
+
     def flip_person(self, src_phrase, text_utils):
-        inwords = text_utils.tokenize(src_phrase)
-        outwords = []
-        for word in inwords:
-            uword = word.lower()
-            is_Aa = uword != word
+        out_phrase = self.flip_cache.get(src_phrase)
+        if out_phrase is None:
+            outwords = []
+            for word in text_utils.analyze(src_phrase).get_tokens():
+                uword = word.lower()
+                new_word = self.person_flip_table.get(uword, word)
+                if new_word != word and uword != word:
+                    new_word = new_word[0].upper() + new_word[1:]
+                outwords.append(new_word)
 
-            new_word = word
-            if uword in self.hard_replacement:
-                new_word = self.hard_replacement[uword]
-            else:
-                if uword in self.person_change_1s_2s:
-                    new_word = self.person_change_1s_2s[uword]
-                elif uword in self.person_change_2s_1s:
-                    new_word = self.person_change_2s_1s[uword]
-                elif uword in self.person_change_2p_1s:
-                    new_word = self.person_change_2p_1s[uword]
-                else:
-                    # немного хардкода.
-                    if uword in self.special_changes_3:
-                        new_word = self.special_changes_3[uword]
-
-            if new_word != word and is_Aa:
-                new_word = new_word[0].upper() + new_word[1:]
+            out_phrase = self.normalize_delimiters(' '.join(outwords))
+            self.flip_cache.put(src_phrase, out_phrase)
 
-            outwords.append(new_word)
-
-        return self.normalize_delimiters(' '.join(outwords))
+        return out_phrase
 
     def postprocess_prepositions(self, s):
-        s = re.sub(r'\bко тебе\b', 'к тебе', s)
-        s = re.sub(r'\bобо тебе\b', 'о тебе', s)
-        s = re.sub(r'\bсо тобой\b', 'с тобой', s)
-        s = re.sub(r'\bво тебе\b', 'в тебе', s)
-
-        s = re.sub(r'\bк мне\b', 'ко мне', s)
-        s = re.sub(r'\bо мне\b', 'обо мне', s)
-        s = re.sub(r'\bс мной\b', 'со мной', s)
-        s = re.sub(r'\bв мне\b', 'во мне', s)
-        return s
+        return PREPOSITION_FIXES_RX.sub(lambda m: PREPOSITION_FIXES[m.group(1)], s)
 
     def normalize_delimiters(self, s):
         return s.replace(' ?', '?').replace(' ,', ',').replace(' .', '.').replace(' !', '!')
 
     def normalize_person(self, raw_phrase, text_utils):
-        return self.normalize_delimiters(self.postprocess_prepositions(self.flip_person(raw_phrase, text_utils)))
+        out_phrase = self.normalize_cache.get(raw_phrase)
+        if out_phrase is None:
+            out_phrase = self.normalize_delimiters(self.postprocess_prepositions(self.flip_person(raw_phrase, text_utils)))
+            self.normalize_cache.put(raw_phrase, out_phrase)
+        return out_phrase
 
     def denormalize_person(self, normal_phrase, text_utils):
-        return self.normalize_delimiters(self.postprocess_prepositions(self.flip_person(normal_phrase, text_utils)))
+        # Смена лица симметрична, поэтому денормализация совпадает с нормализацией
+        return self.normalize_person(normal_phrase, text_utils)
+
+
+if __name__ == '__main__':
+    # Сверка объединенной таблицы и одного регулярного выражения с прежней реализацией.
+    # Таблицы смены лица берутся из person_change_dictionary.pickle в каталоге моделей (--models_dir или
+    # переменная окружения RUCHATBOT_MODELS), а если каталог не задан - из небольшой встроенной таблицы,
+    # в которой есть пересечения между таблицами для проверки приоритетов.
+    # Фразы для сверки - факты из указанных файлов, по умолчанию из каталога data репозитория.
+    import argparse
+    import io
+    import sys
+    from ruchatbot.bot.text_utils import TextUtils
+
+    data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data')
+    parser = argparse.ArgumentParser(description='Person flip equivalence check')
+    parser.add_argument('--models_dir', type=str, default=os.getenv('RUCHATBOT_MODELS'))
+    parser.add_argument('facts', type=str, nargs='*',
+                        default=[os.path.join(data_dir, 'profile_facts_1.dat'), os.path.join(data_dir, 'shared_facts.dat')])
+    args = parser.parse_args()
+
+    text_utils = TextUtils()
+    text_utils.load_dictionaries(None, args.models_dir)
+    interpreter = BaseUtteranceInterpreter2()
+    if args.models_dir:
+        interpreter.load(args.models_dir)
+    else:
+        interpreter.init_person_tables({'person_change_1s_2s': {'иду': 'идешь', 'люблю': 'любишь', 'мой': 'твой', 'меня': 'тебя'},
+                                        'person_change_2s_1s': {'идешь': 'иду', 'любишь': 'люблю', 'тебе': 'мне', 'иду': 'идет'},
+                                        'person_change_2p_1s': {'идете': 'иду', 'любите': 'люблю', 'вас': 'нас', 'ты': 'вы'},
+                                        })
+
+    def flip_person0(src_phrase):
+        outwords = []
+        for word in text_utils.tokenize(src_phrase):
+            uword = word.lower()
+            new_word = word
+            if uword in interpreter.hard_replacement:
+                new_word = interpreter.hard_replacement[uword]
+            elif uword in interpreter.person_change_1s_2s:
+                new_word = interpreter.person_change_1s_2s[uword]
+            elif uword in interpreter.person_change_2s_1s:
+                new_word = interpreter.person_change_2s_1s[uword]
+            elif uword in interpreter.person_change_2p_1s:
+                new_word = interpreter.person_change_2p_1s[uword]
+            elif uword in interpreter.special_changes_3:
+                new_word = interpreter.special_changes_3[uword]
+            if new_word != word and uword != word:
+                new_word = new_word[0].upper() + new_word[1:]
+            outwords.append(new_word)
+        return interpreter.normalize_delimiters(' '.join(outwords))
+
+    def postprocess_prepositions0(s):
+        for src, dst in PREPOSITION_FIXES.items():
+            s = re.sub(r'\b' + src + r'\b', dst, s)
+        return s
+
+    phrases = ['Как тебя зовут?', 'Я к тебе приду', 'Расскажи о мне', 'Ты со мной?', 'Я обо тебе думаю', 'Вы в мне уверены?',
+               'Я иду к вам', 'Ты любишь меня?', 'Вас любите вы?', 'Мой кот идет к тебе']
+    for facts_path in args.facts:
+        with io.open(facts_path, 'r', encoding='utf-8') as rdr:
+            for line in rdr:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    phrases.extend(s.strip() for s in line.split('|'))
+
+    nb_errors = 0
+    for phrase in phrases:
+        expected = interpreter.normalize_delimiters(postprocess_prepositions0(flip_person0(phrase)))
+        for got, exp in [(interpreter.flip_person(phrase, text_utils), flip_person0(phrase)),
+                         (interpreter.normalize_person(phrase, text_utils), expected),
+                         (interpreter.normalize_person(phrase, text_utils), expected)]:  # повторный вызов - из кэша
+            if got != exp:
+                print('MISMATCH for "{}": got "{}", expected "{}"'.format(phrase, got, exp))
+                nb_errors += 1
+                break
+
+    print('{} phrases checked, {} mismatches, flip cache hit rate={:.3f}'.format(len(phrases), nb_errors, interpreter.flip_cache.get_hit_rate()))
+    sys.exit(1 if nb_errors else 0)
@@ -2,6 +2,9 @@
 Конфигурация бота - флаги, настроечные константы.
 
 13-04-2021 добавлен параметр "scenarios_enabled" для (раз)блокировки сценариев
+19-10-2026 добавлен параметр "reply_pool_oversample" - сколько реплик генерировать для контекстов уклонения
+           и читчата, лишние реплики сохраняются в пуле (ReplyPool). Значение не больше 2 (столько реплик
+           нужно на каждый контекст) отключает пул.
 """
 
 import json
@@ -92,3 +95,29 @@ class BotProfile(object):
     @property
     def personal_question_answering_policy(self):
         return self.profile.get('personal_questions_answering_policy', BotProfile.PERSONAL_QUESTIONS_ANSWERING__GENERAL)
+
+    # Политика пропуска интерпретации для законченных реплик собеседника, которые closure-детектор оценивает высоко
+    INTERPRETATION_GATE__OFF = 'off'        # интерпретация выполняется всегда
+    INTERPRETATION_GATE__SKIP = 'skip'      # реплика используется как есть, интерпретатор не вызывается
+    INTERPRETATION_GATE__REDUCE = 'reduce'  # интерпретатор вызывается для одного контекста и с одним сэмплом
+
+    @property
+    def interpretation_gate_policy(self):
+        return self.profile.get('interpretation_gate_policy', BotProfile.INTERPRETATION_GATE__OFF)
+
+    @property
+    def interpretation_gate_threshold(self):
+        return self.profile.get('interpretation_gate_threshold', 0.90)
+
+    @property
+    def interpretation_gate_min_words(self):
+        return self.profile.get('interpretation_gate_min_words', 4)
+
+    @property
+    def reply_pool_oversample(self):
+        """
+        Сколько реплик генерировать для контекста уклонения/читчата, которого нет в пуле реплик.
+        Лишние реплики сверх нужных сейчас сохраняются в пуле. Если значение не больше количества
+        нужных реплик, пул не используется совсем.
+        """
+        return self.profile.get('reply_pool_oversample', 6)
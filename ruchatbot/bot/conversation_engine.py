@@ -17,8 +17,16 @@
 01.11.2022 Рефакторинг: код для запуска в консоли, телеграм-бота и rest api сервиса вынесен в отдельные модули, см. подкаталог frontend
 05.11.2022 Эксперимент с использованием новой модели для раскрытия неполных реплик на базе rut5
 13.11.2022 Втаскиваем код скриптования - сценарии, жадные правила.
+19.10.2026 Пул заранее сгенерированных реплик для повторяющихся контекстов уклонения, "нет информации" и читчата.
+19.10.2026 Кэширование токенизации реплик в истории диалога, промпты собираются из готовых id токенов.
+19.10.2026 Опциональный KV-кэш gpt-читчата для истории каждой сессии (session_kv_cache_tokens).
+19.10.2026 Проверка лучших реплик-кандидатов порциями по validation_top_k штук с батчевыми прогонами моделей.
+19.10.2026 Пропуск или урезание интерпретации законченных реплик собеседника по политике профиля (interpretation_gate_policy).
+19.10.2026 Реплики контекста для правил парсятся одним пакетом.
+19.10.2026 Токенизация и разбиение на клаузы через общий для компонентов кэш анализа реплик (TextUtils.analyze).
 """
 
+import atexit
 import collections
 import math
 from typing import List, Set, Dict, Tuple, Optional
@@ -39,7 +47,8 @@ from ruchatbot.bot.base_utterance_interpreter2 import BaseUtteranceInterpreter2
 from ruchatbot.bot.sbert_paraphrase_detector import SbertSynonymyDetector
 from ruchatbot.bot.modality_detector import ModalityDetector
 from ruchatbot.bot.simple_modality_detector import SimpleModalityDetectorRU
-from ruchatbot.bot.profile_facts_reader import ProfileFactsReader
+from ruchatbot.bot.profile_facts_reader import ProfileFactsReader, ProfileFactsSnapshot
+from ruchatbot.bot.bot_profile import BotProfile
 #from ruchatbot.bot.rugpt_interpreter import RugptInterpreter
 from ruchatbot.bot.rut5_interpreter import RuT5Interpreter
 #from ruchatbot.bot.rugpt_confabulator import RugptConfabulator
@@ -51,6 +60,8 @@ from ruchatbot.scripting.running_scenario import RunningDialogStatus
 from ruchatbot.scripting.running_scenario import RunningScenario
 from ruchatbot.scripting.matcher.matching_cache import MatchingCache
 from ruchatbot.bot.search_utils import search_among
+from ruchatbot.bot.reply_pool import ReplyPool
+from ruchatbot.bot.prompt_tokens_cache import PromptTokensCache
 
 
 class Utterance:
@@ -85,6 +96,7 @@ class DialogHistory(object):
         self.user_id = user_id
         self.messages = []
         self.replies_queue = []
+        self.prompt_tokens = PromptTokensCache()  # id токенов реплик для токенизаторов читчата и интерпретатора
 
     def get_interlocutor(self):
         return self.user_id
@@ -369,13 +381,23 @@ class ResponseGenerationPromise(object):
         r = ResponseGenerationPromise()
         r.text = text
         r.chitchat_generation_context = None
+        r.pooled = False
+        r.premise_grounded = False
         return r
 
     @staticmethod
-    def make_promise(chitchat_generation_context: List[str]):
+    def make_promise(chitchat_generation_context: List[str], pooled: bool = False, premise_grounded: bool = False):
+        """
+        pooled=True - реплики для этого контекста можно брать из пула ранее сгенерированных
+        и складывать туда лишние сэмплы (см. ReplyPool).
+        premise_grounded=True - ответ генерируется по тексту предпосылок и обычно копирует их фрагменты,
+        поэтому для него можно использовать prompt lookup декодирование.
+        """
         r = ResponseGenerationPromise()
         r.text = None
         r.chitchat_generation_context = chitchat_generation_context
+        r.pooled = pooled
+        r.premise_grounded = premise_grounded
         return r
 
     def __repr__(self):
@@ -431,6 +453,19 @@ class BotCore:
         self.logger.debug('BotCore: device=%s', str(self.device))
         self.min_nonsense_threshold = 0.50  # мин. значение синтаксической валидности сгенерированной моделями фразы, чтобы использовать ее дальше
         self.pqa_rel_threshold = 0.80  # порог отсечения нерелевантных предпосылок
+        self.reply_pool = ReplyPool(max_contexts=1000, ttl=600.0)  # пул реплик для повторяющихся контекстов читчата
+        self.session_kv_cache_tokens = 0  # суммарный лимит токенов для KV-кэшей сессий в читчате, 0 - кэш отключен (замер: python -m ruchatbot.bot.rugpt_chitchat --benchmark_session_kv_cache)
+        self.interpretation_cache_size = 10000  # размер кэша интерпретаций T5, 0 - кэш отключен
+        self.interpretation_cache_ttl = 600.0  # время жизни интерпретации в кэше, сек
+        self.p2q_score_cache_path = None  # файл для кэша оценок пар предпосылок в P2Q, читается при загрузке и пишется при выходе
+        self.parse_workers = 0  # сколько процессов парсят факты профиля при загрузке, 0 или 1 - парсинг в основном процессе
+        self.validation_top_k = 1  # сколько реплик-кандидатов проверять вместе при выборе ответа
+
+    def save_caches(self):
+        """Сохраняем на диск кэши, для которых это настроено. Вызывается при завершении работы бота."""
+        if self.p2q_score_cache_path is not None:
+            self.logger.info('Saving P2Q pair score cache to "%s"', self.p2q_score_cache_path)
+            self.p2q_scorer.save_score12_cache(self.p2q_score_cache_path)
 
     def load_bert(self, bert_path):
         self.bert_tokenizer = transformers.BertTokenizer.from_pretrained(bert_path, do_lower_case=False)
@@ -457,8 +492,12 @@ class BotCore:
             self.closure_detector.bert_model = self.bert_model
             self.closure_detector.bert_tokenizer = self.bert_tokenizer
 
-        self.p2q_scorer = RelevancyScorer(text_utils.parser)
+        self.p2q_scorer = RelevancyScorer(text_utils)
+        self.p2q_scorer.score12_cache_path = self.p2q_score_cache_path
+        self.p2q_scorer.parse_workers = self.parse_workers
         self.p2q_scorer.load(models_dir)
+        if self.p2q_score_cache_path is not None:
+            atexit.register(self.save_caches)
 
         # Модель определения модальности фраз собеседника
         self.modality_model = SimpleModalityDetectorRU()
@@ -471,7 +510,7 @@ class BotCore:
         #self.entailment.load(models_dir, self.bert_model, self.bert_tokenizer)
 
         #self.interpreter = RugptInterpreter()
-        self.interpreter = RuT5Interpreter()
+        self.interpreter = RuT5Interpreter(cache_size=self.interpretation_cache_size, cache_ttl=self.interpretation_cache_ttl)
         self.interpreter.load(models_dir)
 
         #self.confabulator = RugptConfabulator()
@@ -479,10 +518,21 @@ class BotCore:
 
         self.chitchat = RugptChitChat()
         self.chitchat.load(os.path.join(models_dir, 'rugpt_npqa'))
+        if self.session_kv_cache_tokens > 0:
+            self.chitchat.enable_session_kv_cache(self.session_kv_cache_tokens)
 
         self.base_interpreter = BaseUtteranceInterpreter2()
         self.base_interpreter.load(models_dir)
 
+    def index_profile_facts(self, bot_profile):
+        """
+        Леммы всех вариантов фактов профиля для P(2)Q извлекаем один раз при загрузке бота,
+        чтобы при ответах на вопросы парсить только вопрос.
+        """
+        snapshot = ProfileFactsSnapshot.get_snapshot(bot_profile.premises_path, bot_profile.constants, self.text_utils)
+        nb_indexed = self.p2q_scorer.index_premises(text for texts in snapshot.variants for text in texts)
+        self.logger.info('P2Q index: %d profile facts indexed', nb_indexed)
+
     def print_dialog(self, dialog):
         logging.debug('='*70)
         table = [['turn', 'side', 'message', 'interpretation']]
@@ -500,6 +550,7 @@ class BotCore:
         # TODO - проверка на непротиворечивость и неповторение
         self.logger.debug('Storing new fact 〚%s〛 in bot="%s" database', fact_text, profile.get_bot_id())
         facts.store_new_fact(dialog.get_interlocutor(), fact_text, label, True)
+        self.p2q_scorer.index_premises([fact_text])
 
     def start_greeting_scenario(self, session):
         dialog = session.dialog
@@ -545,7 +596,7 @@ class BotCore:
 
         dialog.add_command(command)
         chitchat_context = dialog.construct_chitchat_context(last_utterance_interpretation=None, last_utterance_labels=None, include_commands=True)
-        chitchat_outputs = self.chitchat.generate_chitchat(context_replies=chitchat_context, num_return_sequences=1)
+        chitchat_outputs = self.chitchat.generate_chitchat(context_replies=chitchat_context, num_return_sequences=1, tokens_cache=dialog.prompt_tokens, session_id=dialog.get_interlocutor())
         self.logger.debug('Chitchat@542 start greeting scenario: context=〚%s〛 outputs=%s', ' | '.join(chitchat_context), format_outputs(chitchat_outputs))
         greeting_text = chitchat_outputs[0]
         dialog.add_bot_message(greeting_text)
@@ -674,6 +725,11 @@ class BotCore:
                 if len(session.dialog.messages) > 2:
                     context['h3'] = session.dialog.messages[-3]
 
+            # Тексты и интерпретации реплик контекста парсим одним пакетом, правила возьмут результаты из кэша парсера.
+            # Большинству правил синтаксис не нужен, правила с составляющими ⟦...⟧ допарсят реплики сами.
+            rule_texts = [text for message in context.values() for text in (message.get_text(), message.get_interpretation()) if text]
+            self.text_utils.parser.parse_batch(rule_texts, need_syntax=False)
+
             # 21.11.2022 сгенерируем варианты ответной реплики с помощью глобальных smalltalk-правил
             for rule in session.bot_profile.scripting.smalltalk_rules:
                 m = rule.match(dialog_context=context,
@@ -738,20 +794,39 @@ class BotCore:
         # Никакой другой информации для ответа на вопрос при этом не требуется.
         # Небольшое ограничение: входим в эту ветку только в случае, если реплика заканчивается знаком вопроса.
         all_answered_texts = set()
-        if dialog.get_last_message().get_text().endswith('?'):
-            text0 = dialog.get_last_message().get_text()
-            rel_p0q = self.closure_detector.calc_label(text0)
-            self.logger.debug('Closure detector P(0)Q @460: text=〚%s〛 rel_p0q=%5.3f', text0, rel_p0q)
-            if rel_p0q > self.pqa_rel_threshold:
-                p0qa_responses = self.generate_p0qa_reply(dialog=dialog, prev_utterance_interpretation=text0, reply_text=text0, rel_p0q=rel_p0q)
+        text0 = dialog.get_last_message().get_text()
+        rel_p0q0 = None
+        if text0.endswith('?'):
+            rel_p0q0 = self.closure_detector.calc_label(text0)
+            self.logger.debug('Closure detector P(0)Q @460: text=〚%s〛 rel_p0q=%5.3f', text0, rel_p0q0)
+            if rel_p0q0 > self.pqa_rel_threshold:
+                p0qa_responses = self.generate_p0qa_reply(dialog=dialog, prev_utterance_interpretation=text0, reply_text=text0, rel_p0q=rel_p0q0)
                 responses.extend(p0qa_responses)
                 all_answered_texts.add(text0)
 
         # 16-02-2022 интерпретация реплики пользователя выполняется всегда, полагаемся на устойчивость генеративной gpt-модели интерпретатора.
+        # 19.10.2026 кроме случаев, когда реплика законченная и профиль бота разрешает пропуск интерпретации.
         all_interpretations = []
-        interpreter_contexts = dialog.constuct_interpreter_contexts()
-        for interpreter_context in interpreter_contexts:
-            interpretations = self.interpreter.interpret([z.strip() for z in interpreter_context.split('|')], num_return_sequences=2)
+        gate_policy, rel_p0q0 = self.check_interpretation_gate(text0, rel_p0q0, session.bot_profile)
+        if gate_policy == BotProfile.INTERPRETATION_GATE__SKIP:
+            interpreter_contexts = []
+            all_interpretations.append((text0, 1.0))
+        else:
+            # Все контексты интерпретатора обрабатываются одним батчем.
+            interpreter_contexts = dialog.constuct_interpreter_contexts()
+            num_return_sequences = 2
+            if gate_policy == BotProfile.INTERPRETATION_GATE__REDUCE:
+                # Контексты отсортированы по убыванию длины, и без гейта побеждает первая интерпретация
+                # самого длинного контекста (см. ниже all_interpretations[:1]). Оставляем только его.
+                interpreter_contexts = interpreter_contexts[:1]
+                num_return_sequences = 1
+
+        interpretations_batch = []
+        if interpreter_contexts:
+            interpretations_batch = self.interpreter.interpret_batch([[z.strip() for z in interpreter_context.split('|')] for interpreter_context in interpreter_contexts],
+                                                                     num_return_sequences=num_return_sequences,
+                                                                     tokens_cache=dialog.prompt_tokens)
+        for interpreter_context, interpretations in zip(interpreter_contexts, interpretations_batch):
             self.logger.debug('Interpretation@755: context=〚%s〛 outputs=〚%s〛', interpreter_context, format_outputs(interpretations))
 
             # Оцениваем "разумность" получившихся интерпретаций, чтобы отсеять заведомо поломанные результаты
@@ -780,9 +855,16 @@ class BotCore:
         mapped_premises = dict()
         for interpretation, p_interp in all_interpretations:
             # Вторая попытка применить p(0)q схему, теперь уже для интерпретации
-            rel_p0q = self.closure_detector.calc_label(interpretation)
+            if interpretation == text0 and rel_p0q0 is not None:
+                # оценка для исходной реплики уже посчитана
+                rel_p0q = rel_p0q0
+            else:
+                rel_p0q = self.closure_detector.calc_label(interpretation)
             self.logger.debug('Closure detector P(0)Q @496: text=〚%s〛 rel_p0q=%5.3f', interpretation, rel_p0q)
-            if rel_p0q > self.pqa_rel_threshold:
+            # При сработавшем гейте интерпретацией может быть сама реплика text0, на которую P(0)Q ответ уже сгенерирован выше,
+            # повторно его не генерируем. Без гейта поведение прежнее.
+            already_answered = gate_policy != BotProfile.INTERPRETATION_GATE__OFF and interpretation in all_answered_texts
+            if rel_p0q > self.pqa_rel_threshold and not already_answered:
                 p0qa_responses = self.generate_p0qa_reply(dialog=dialog, prev_utterance_interpretation=interpretation, reply_text=interpretation, rel_p0q=rel_p0q * p_interp)
                 responses.extend(p0qa_responses)
                 all_answered_texts.add(interpretation)
@@ -890,11 +972,11 @@ class BotCore:
                                 score = 1.0
 
                                 # Может быть несколько предпосылок, поэтому бьем на клаузы.
-                                premises = self.text_utils.split_clauses(confab_text)
+                                premises = list(self.text_utils.analyze(confab_text).get_clauses())
 
                                 # Понижаем достоверность конфабуляций, относящихся к собеседнику.
                                 for premise in premises:
-                                    words = self.text_utils.tokenize(premise)
+                                    words = self.text_utils.analyze(premise).get_tokens()
                                     if any((w.lower() == 'ты') for w in words):
                                         score *= 0.5
 
@@ -985,7 +1067,7 @@ class BotCore:
         # Генерируем отложенные реплики.
         responses2 = [response for response in responses if response.generation_promise.is_generated()]
         chitchat_promises = [r for r in responses if r.generation_promise.is_promised()]
-        responses3 = self.generate_promised_responses(chitchat_promises)
+        responses3 = self.generate_promised_responses(chitchat_promises, session)
 
         # Генерация вариантов ответной реплики закончена.
         responses = responses2 + responses3
@@ -993,7 +1075,7 @@ class BotCore:
         # Делаем оценку сгенерированных реплик - насколько хорошо они вписываются в текущий контекст диалога
         chitchat_context0 = dialog.construct_chitchat_context(last_utterance_interpretation=None, last_utterance_labels=None, include_commands=False)
         #px_entail = self.entailment.predictN(' | '.join(chitchat_context0), [r.get_text() for r in responses])
-        px_entail = self.chitchat.score_dialogues([(chitchat_context0 + [r.get_text()]) for r in responses])
+        px_entail = self.chitchat.score_dialogues([(chitchat_context0 + [r.get_text()]) for r in responses], tokens_cache=dialog.prompt_tokens)
 
         for r, p_entail in zip(responses, px_entail):
             # 23.11.2022 Если такая реплика уже произносилась ранее, то немного понизим ее оценку, чтобы дать шанс
@@ -1022,101 +1104,7 @@ class BotCore:
         # Выбираем лучший response, запоминаем интерпретацию последней фразы в истории диалога.
         # 16.02.2022 Идем по списку сгенерированных реплик, проверяем реплику на отсутствие противоречий или заеданий.
         # Если реплика плохая - отбрасываем и берем следующую в сортированном списке.
-        self_interpretation = None
-        for best_response in responses:
-            is_good_reply = True
-
-            if best_response.prev_utterance_interpretation is not None:
-                # Если входная обрабатываемая реплика содержит какой-то факт, то его надо учитывать сейчас при поиске
-                # релевантных предпосылок. Но так как мы еще не уверены, что именно данный вариант интерпретации входной
-                # реплики правильный, то просто соберем временный список с добавленной интерпретацией.
-                input_assertions, input_questions = split_message_text(best_response.prev_utterance_interpretation, self.text_utils)
-                memory_phrases2 = list(memory_phrases)
-                for assertion_text in input_assertions:
-                    fact_text2 = self.flip_person(assertion_text)
-                    memory_phrases2.append((fact_text2, '', '(((tmp@1026)))'))
-
-                # Вполне может оказаться, что наша ответная реплика - краткая, и мы должны попытаться восстановить
-                # полную реплику перед семантическими и прагматическими проверками.
-                prevm = best_response.prev_utterance_interpretation # dialog.get_last_message().get_interpretation()
-                if prevm is None:
-                    prevm = dialog.get_last_message().get_text()
-                interpreter_context = prevm + ' | ' + best_response.get_text()
-                self_interpretation = self.interpreter.interpret([z.strip() for z in interpreter_context.split('|')], num_return_sequences=1)[0]
-                self.logger.debug('Self interpretation@1035: context=〚%s〛 output=〚%s〛', interpreter_context, self_interpretation)
-
-                self_assertions, self_questions = split_message_text(self_interpretation, self.text_utils)
-                for question_text in self_questions:
-                    # Реплика содержит вопрос. Проверим, что мы ранее не задавали такой вопрос, и что
-                    # мы не знаем ответ на этот вопрос. Благодаря этому бот не будет спрашивать снова то, что уже
-                    # спрашивал или что он просто знает.
-                    self.logger.debug('Question to process@1042: 〚%s〛', question_text)
-                    premises, rels = self.relevancy_detector.get_most_relevant(question_text, memory_phrases2, nb_results=1)
-                    if len(premises) > 0:
-                        premise = premises[0]
-                        rel = rels[0]
-                        if rel >= self.pqa_rel_threshold:
-                            self.logger.debug('KB lookup@1048: query=〚%s〛 premise=〚%s〛 rel=%f', question_text, premise, rel)
-                            # Так как в БД найден релевантный факт, то бот уже знает ответ на этот вопрос, и нет смысла задавать его
-                            # собеседнику снова.
-                            is_good_reply = False
-                            self.logger.debug('Output response 〚%s〛 contains a question 〚%s〛 with known answer, so skipping it @1052', best_response.get_text(), question_text)
-                            break
-
-                if not is_good_reply:
-                    continue
-
-                # проверяем по БД, нет ли противоречий с утвердительной частью.
-                # Генерации реплики, сделанные из предпосылки в БД, не будем проверять.
-                if best_response.get_algo() != 'pqa_response':
-                    for assertion_text in self_assertions:
-                        # Ищем релевантный факт в БД
-                        premises, rels = self.relevancy_detector.get_most_relevant(assertion_text, memory_phrases2, nb_results=1)
-                        if len(premises) > 0:
-                            premise = premises[0]
-                            rel = rels[0]
-                            if rel >= self.pqa_rel_threshold:
-                                self.logger.debug('KB lookup@1068: query=〚%s〛 premise=〚%s〛 rel=%f', assertion_text, premise, rel)
-
-                                # 23.11.2022 быстрая проверка на случай, когда вопрос и найденная предпосылка символьно близки
-                                str1 = self.text_utils.remove_terminators(premise).lower()
-                                str2 = self.text_utils.remove_terminators(assertion_text).lower()
-                                if str1 == str2:
-                                    # полное совпадение текста
-                                    continue
-
-                                tokens1 = self.text_utils.tokenize(str1)
-                                tokens2 = self.text_utils.tokenize(str2)
-                                if not any((t1 not in tokens2) for t1 in tokens1):
-                                    # совпадение мешков слов
-                                    continue
-
-                                # Формируем запрос на генерацию ответа через gpt читчата...
-                                chitchat_context = premise[0].upper() + premise[1:] #+ '. ' + assertion_text + '?'
-                                if premise[-1] not in '!;.':
-                                    chitchat_context += '.'
-                                if assertion_text[-1] in '.!;':
-                                    chitchat_context += ' ' + assertion_text[:-1] + '?'
-                                elif assertion_text[-1] == '?':
-                                    chitchat_context += ' ' + assertion_text
-                                else:
-                                    chitchat_context += ' ' + assertion_text + '?'
-
-                                chitchat_outputs = self.chitchat.generate_chitchat(context_replies=[chitchat_context], num_return_sequences=5)
-                                self.logger.debug('PQA@1095: context=〚%s〛 outputs=〚%s〛', chitchat_context, format_outputs(chitchat_outputs))
-                                for chitchat_output in chitchat_outputs:
-                                    # Заглушка - ищем отрицательные частицы
-                                    words = self.text_utils.tokenize(chitchat_output)
-                                    if any((w.lower() in ['нет', 'не']) for w in words):
-                                        is_good_reply = False
-                                        self.logger.debug('Output response 〚%s〛 contains assertion 〚%s〛 which contradicts the knowledge base', best_response.get_text(), assertion_text)
-                                        break
-
-                                if not is_good_reply:
-                                    break
-
-            if is_good_reply:
-                break
+        best_response, self_interpretation = self.select_best_response(responses, memory_phrases, dialog)
 
         # Если для генерации этой ответной реплики использована интерпретация предыдущей реплики собеседника,
         # то надо запомнить эту интерпретацию в истории диалога.
@@ -1210,15 +1198,320 @@ class BotCore:
 
         return responses
 
-    def generate_promised_responses(self, chitchat_promises):
+    def check_interpretation_gate(self, text0, rel_p0q0, bot_profile):
+        """
+        Решаем, нужна ли полная интерпретация реплики собеседника.
+        Для законченной реплики (высокая оценка closure-детектора, достаточно слов) по политике профиля
+        интерпретацию можно пропустить или урезать.
+        Вернет политику, которую надо применить, и оценку closure-детектора для реплики (если она посчитана).
+        """
+        policy = bot_profile.interpretation_gate_policy
+        if policy == BotProfile.INTERPRETATION_GATE__OFF:
+            return policy, rel_p0q0
+
+        nb_words = sum(1 for w in self.text_utils.analyze(text0).get_tokens() if any(c.isalnum() for c in w))
+        if nb_words < bot_profile.interpretation_gate_min_words:
+            self.logger.debug('Interpretation gate@1150: text=〚%s〛 words=%d policy=%s decision=interpret', text0, nb_words, policy)
+            return BotProfile.INTERPRETATION_GATE__OFF, rel_p0q0
+
+        if rel_p0q0 is None:
+            rel_p0q0 = self.closure_detector.calc_label(text0)
+
+        if rel_p0q0 >= bot_profile.interpretation_gate_threshold:
+            self.logger.debug('Interpretation gate@1158: text=〚%s〛 words=%d rel_p0q=%5.3f policy=%s decision=%s', text0, nb_words, rel_p0q0, policy, policy)
+            return policy, rel_p0q0
+
+        self.logger.debug('Interpretation gate@1161: text=〚%s〛 words=%d rel_p0q=%5.3f policy=%s decision=interpret', text0, nb_words, rel_p0q0, policy)
+        return BotProfile.INTERPRETATION_GATE__OFF, rel_p0q0
+
+    def select_best_response(self, responses, memory_phrases, dialog):
+        """
+        Идем по отсортированному списку реплик-кандидатов и выбираем первую, прошедшую проверки в validate_responses.
+        Кандидаты проверяются порциями по validation_top_k штук, чтобы прогоны моделей для всей порции делать батчами.
+        При validation_top_k=1 кандидаты проверяются по одному с выходом на первой найденной проблеме.
+        Если ни одна реплика не прошла проверки, берем последнюю.
+        Вернет выбранную реплику и ее самоинтерпретацию.
+        """
+        portion_size = max(1, self.validation_top_k)
+        if portion_size == 1:
+            return self.select_best_response_sequential(responses, memory_phrases, dialog)
+
+        best_response = None
+        self_interpretation = None
+        for start in range(0, len(responses), portion_size):
+            candidates = responses[start: start + portion_size]
+            verdicts = self.validate_responses(candidates, memory_phrases, dialog)
+            for best_response, (is_good_reply, self_interpretation) in zip(candidates, verdicts):
+                if is_good_reply:
+                    return best_response, self_interpretation
+
+        return best_response, self_interpretation
+
+    def select_best_response_sequential(self, responses, memory_phrases, dialog):
+        self_interpretation = None
+        best_response = None
+        for best_response in responses:
+            is_good_reply = True
+
+            if best_response.prev_utterance_interpretation is not None:
+                # Если входная обрабатываемая реплика содержит какой-то факт, то его надо учитывать сейчас при поиске
+                # релевантных предпосылок. Но так как мы еще не уверены, что именно данный вариант интерпретации входной
+                # реплики правильный, то просто соберем временный список с добавленной интерпретацией.
+                input_assertions, input_questions = split_message_text(best_response.prev_utterance_interpretation, self.text_utils)
+                memory_phrases2 = list(memory_phrases)
+                for assertion_text in input_assertions:
+                    fact_text2 = self.flip_person(assertion_text)
+                    memory_phrases2.append((fact_text2, '', '(((tmp@1026)))'))
+
+                # Вполне может оказаться, что наша ответная реплика - краткая, и мы должны попытаться восстановить
+                # полную реплику перед семантическими и прагматическими проверками.
+                prevm = best_response.prev_utterance_interpretation
+                interpreter_context = prevm + ' | ' + best_response.get_text()
+                self_interpretation = self.interpreter.interpret([z.strip() for z in interpreter_context.split('|')], num_return_sequences=1, tokens_cache=dialog.prompt_tokens)[0]
+                self.logger.debug('Self interpretation@1035: context=〚%s〛 output=〚%s〛', interpreter_context, self_interpretation)
+
+                self_assertions, self_questions = split_message_text(self_interpretation, self.text_utils)
+                for question_text in self_questions:
+                    # Реплика содержит вопрос. Проверим, что мы ранее не задавали такой вопрос, и что
+                    # мы не знаем ответ на этот вопрос. Благодаря этому бот не будет спрашивать снова то, что уже
+                    # спрашивал или что он просто знает.
+                    self.logger.debug('Question to process@1042: 〚%s〛', question_text)
+                    premises, rels = self.relevancy_detector.get_most_relevant(question_text, memory_phrases2, nb_results=1)
+                    if len(premises) > 0:
+                        premise = premises[0]
+                        rel = rels[0]
+                        if rel >= self.pqa_rel_threshold:
+                            self.logger.debug('KB lookup@1048: query=〚%s〛 premise=〚%s〛 rel=%f', question_text, premise, rel)
+                            # Так как в БД найден релевантный факт, то бот уже знает ответ на этот вопрос, и нет смысла задавать его
+                            # собеседнику снова.
+                            is_good_reply = False
+                            self.logger.debug('Output response 〚%s〛 contains a question 〚%s〛 with known answer, so skipping it @1052', best_response.get_text(), question_text)
+                            break
+
+                if not is_good_reply:
+                    continue
+
+                # проверяем по БД, нет ли противоречий с утвердительной частью.
+                # Генерации реплики, сделанные из предпосылки в БД, не будем проверять.
+                if best_response.get_algo() != 'pqa_response':
+                    for assertion_text in self_assertions:
+                        # Ищем релевантный факт в БД
+                        premises, rels = self.relevancy_detector.get_most_relevant(assertion_text, memory_phrases2, nb_results=1)
+                        if len(premises) > 0:
+                            premise = premises[0]
+                            rel = rels[0]
+                            if rel >= self.pqa_rel_threshold:
+                                self.logger.debug('KB lookup@1068: query=〚%s〛 premise=〚%s〛 rel=%f', assertion_text, premise, rel)
+                                chitchat_context = self.make_contradiction_probe(premise, assertion_text)
+                                if chitchat_context is None:
+                                    continue
+
+                                chitchat_outputs = self.chitchat.generate_chitchat(context_replies=[chitchat_context], num_return_sequences=5, tokens_cache=dialog.prompt_tokens)
+                                self.logger.debug('PQA@1095: context=〚%s〛 outputs=〚%s〛', chitchat_context, format_outputs(chitchat_outputs))
+                                if self.is_contradiction(chitchat_outputs):
+                                    is_good_reply = False
+                                    self.logger.debug('Output response 〚%s〛 contains assertion 〚%s〛 which contradicts the knowledge base', best_response.get_text(), assertion_text)
+                                    break
+
+            if is_good_reply:
+                break
+
+        return best_response, self_interpretation
+
+    def make_contradiction_probe(self, premise, assertion_text):
+        """
+        Контекст для генерации ответа читчатом на вопрос, построенный из утверждения, по найденной в БЗ предпосылке.
+        Вернет None, если предпосылка и утверждение совпадают и проверять нечего.
+        """
+        # 23.11.2022 быстрая проверка на случай, когда вопрос и найденная предпосылка символьно близки
+        str1 = self.text_utils.remove_terminators(premise).lower()
+        str2 = self.text_utils.remove_terminators(assertion_text).lower()
+        if str1 == str2:
+            # полное совпадение текста
+            return None
+
+        tokens1 = self.text_utils.analyze(str1).get_tokens()
+        tokens2 = self.text_utils.analyze(str2).get_tokens()
+        if not any((t1 not in tokens2) for t1 in tokens1):
+            # совпадение мешков слов
+            return None
+
+        # Формируем запрос на генерацию ответа через gpt читчата...
+        chitchat_context = premise[0].upper() + premise[1:] #+ '. ' + assertion_text + '?'
+        if premise[-1] not in '!;.':
+            chitchat_context += '.'
+        if assertion_text[-1] in '.!;':
+            chitchat_context += ' ' + assertion_text[:-1] + '?'
+        elif assertion_text[-1] == '?':
+            chitchat_context += ' ' + assertion_text
+        else:
+            chitchat_context += ' ' + assertion_text + '?'
+
+        return chitchat_context
+
+    def is_contradiction(self, chitchat_outputs):
+        for chitchat_output in chitchat_outputs:
+            # Заглушка - ищем отрицательные частицы
+            words = self.text_utils.analyze(chitchat_output).get_tokens()
+            if any((w.lower() in ['нет', 'не']) for w in words):
+                return True
+        return False
+
+    def validate_responses(self, candidates, memory_phrases, dialog):
+        """
+        Проверяем реплики-кандидаты на отсутствие вопросов, ответ на которые боту уже известен,
+        и утверждений, противоречащих базе знаний.
+        Самоинтерпретации, поиск в БЗ и генерация для проверки противоречий выполняются батчами для всех кандидатов.
+        Вернет для каждого кандидата пару (реплика годится, самоинтерпретация).
+        """
+        is_good = [True] * len(candidates)
+        self_interpretations = [None] * len(candidates)
+
+        checked = [i for i, candidate in enumerate(candidates) if candidate.prev_utterance_interpretation is not None]
+        if not checked:
+            return list(zip(is_good, self_interpretations))
+
+        # Если входная обрабатываемая реплика содержит какой-то факт, то его надо учитывать сейчас при поиске
+        # релевантных предпосылок. Но так как мы еще не уверены, что именно данный вариант интерпретации входной
+        # реплики правильный, то просто соберем временный список с добавленной интерпретацией.
+        interpretation2memory = dict()
+        for i in checked:
+            prev_interpretation = candidates[i].prev_utterance_interpretation
+            if prev_interpretation not in interpretation2memory:
+                input_assertions, input_questions = split_message_text(prev_interpretation, self.text_utils)
+                memory_phrases2 = list(memory_phrases)
+                for assertion_text in input_assertions:
+                    fact_text2 = self.flip_person(assertion_text)
+                    memory_phrases2.append((fact_text2, '', '(((tmp@1026)))'))
+                interpretation2memory[prev_interpretation] = memory_phrases2
+
+        # Вполне может оказаться, что наша ответная реплика - краткая, и мы должны попытаться восстановить
+        # полную реплику перед семантическими и прагматическими проверками.
+        interpreter_contexts = [candidates[i].prev_utterance_interpretation + ' | ' + candidates[i].get_text() for i in checked]
+        interpretations_batch = self.interpreter.interpret_batch([[z.strip() for z in interpreter_context.split('|')] for interpreter_context in interpreter_contexts],
+                                                                 num_return_sequences=1,
+                                                                 tokens_cache=dialog.prompt_tokens)
+        self_clauses = dict()
+        for i, interpreter_context, interpretations in zip(checked, interpreter_contexts, interpretations_batch):
+            self_interpretations[i] = interpretations[0]
+            self.logger.debug('Self interpretation@1035: context=〚%s〛 output=〚%s〛', interpreter_context, self_interpretations[i])
+            self_clauses[i] = split_message_text(self_interpretations[i], self.text_utils)
+
+        # Реплика содержит вопрос. Проверим, что мы ранее не задавали такой вопрос, и что
+        # мы не знаем ответ на этот вопрос. Благодаря этому бот не будет спрашивать снова то, что уже
+        # спрашивал или что он просто знает.
+        queries = [(i, question_text) for i in checked for question_text in self_clauses[i][1]]
+        for (i, question_text), (premise, rel) in zip(queries, self.lookup_candidate_queries(queries, candidates, interpretation2memory)):
+            self.logger.debug('Question to process@1042: 〚%s〛', question_text)
+            if is_good[i] and premise is not None:
+                self.logger.debug('KB lookup@1048: query=〚%s〛 premise=〚%s〛 rel=%f', question_text, premise, rel)
+                # Так как в БД найден релевантный факт, то бот уже знает ответ на этот вопрос, и нет смысла задавать его
+                # собеседнику снова.
+                is_good[i] = False
+                self.logger.debug('Output response 〚%s〛 contains a question 〚%s〛 with known answer, so skipping it @1052', candidates[i].get_text(), question_text)
+
+        # проверяем по БД, нет ли противоречий с утвердительной частью.
+        # Генерации реплики, сделанные из предпосылки в БД, не будем проверять.
+        queries = [(i, assertion_text) for i in checked if is_good[i] and candidates[i].get_algo() != 'pqa_response' for assertion_text in self_clauses[i][0]]
+        contradiction_checks = []
+        for (i, assertion_text), (premise, rel) in zip(queries, self.lookup_candidate_queries(queries, candidates, interpretation2memory)):
+            if premise is not None:
+                self.logger.debug('KB lookup@1068: query=〚%s〛 premise=〚%s〛 rel=%f', assertion_text, premise, rel)
+                chitchat_context = self.make_contradiction_probe(premise, assertion_text)
+                if chitchat_context is not None:
+                    contradiction_checks.append((i, assertion_text, chitchat_context))
+
+        if contradiction_checks:
+            # Длина генерации та же, что и при проверке одного кандидата через generate_chitchat.
+            chitchat_outputs_batch = self.chitchat.generate_chitchat_batch([[chitchat_context] for _, _, chitchat_context in contradiction_checks],
+                                                                           num_return_sequences=5,
+                                                                           tokens_cache=dialog.prompt_tokens,
+                                                                           max_new_tokens=self.chitchat.max_reply_tokens)
+            for (i, assertion_text, chitchat_context), chitchat_outputs in zip(contradiction_checks, chitchat_outputs_batch):
+                self.logger.debug('PQA@1095: context=〚%s〛 outputs=〚%s〛', chitchat_context, format_outputs(chitchat_outputs))
+                if is_good[i] and self.is_contradiction(chitchat_outputs):
+                    is_good[i] = False
+                    self.logger.debug('Output response 〚%s〛 contains assertion 〚%s〛 which contradicts the knowledge base', candidates[i].get_text(), assertion_text)
+
+        return list(zip(is_good, self_interpretations))
+
+    def lookup_candidate_queries(self, queries, candidates, interpretation2memory):
+        """
+        Поиск в БЗ для запросов (индекс кандидата, текст запроса) - по одному батчу на каждый вариант временной БЗ.
+        Для каждого запроса вернет пару (релевантный факт, релевантность) или (None, None).
+        """
+        results = [(None, None)] * len(queries)
+        memory2queries = collections.defaultdict(list)
+        for iquery, (i, query_text) in enumerate(queries):
+            memory2queries[candidates[i].prev_utterance_interpretation].append(iquery)
+
+        for prev_interpretation, iqueries in memory2queries.items():
+            lookups = self.relevancy_detector.get_most_relevant_batch([queries[iquery][1] for iquery in iqueries],
+                                                                      interpretation2memory[prev_interpretation],
+                                                                      nb_results=1)
+            for iquery, (premises, rels) in zip(iqueries, lookups):
+                if len(premises) > 0 and rels[0] >= self.pqa_rel_threshold:
+                    results[iquery] = (premises[0], rels[0])
+
+        return results
+
+    def generate_promised_responses(self, chitchat_promises, session):
         responses = []
+        num_return_sequences = 2
+
+        # Для контекстов уклонения, "нет информации" и читчата сначала пробуем взять готовые реплики из пула.
+        # Если лишних реплик для пула не генерируется, то пул не используется вообще.
+        oversample = session.bot_profile.reply_pool_oversample
+        use_reply_pool = oversample > num_return_sequences
+        promise2outputs = dict()
+        batch_promises = []
+        pool_miss_promises = []
+        for ipromise, promise in enumerate(chitchat_promises):
+            generation_promise = promise.generation_promise
+            if generation_promise.pooled and use_reply_pool:
+                chitchat_outputs = self.reply_pool.draw(generation_promise.chitchat_generation_context, num_return_sequences, session)
+                if chitchat_outputs is not None:
+                    self.logger.debug('Reply pool hit@1230: context=〚%s〛 outputs=〚%s〛', ' | '.join(generation_promise.chitchat_generation_context), format_outputs(chitchat_outputs))
+                    promise2outputs[ipromise] = chitchat_outputs
+                else:
+                    pool_miss_promises.append(ipromise)
+            elif generation_promise.premise_grounded and self.chitchat.prompt_lookup_decoding:
+                # Ответ по предпосылкам генерируем спекулятивным декодированием с черновиками из промпта.
+                promise2outputs[ipromise] = self.chitchat.generate_prompt_lookup(generation_promise.chitchat_generation_context,
+                                                                                 num_return_sequences=num_return_sequences,
+                                                                                 tokens_cache=session.dialog.prompt_tokens)
+            else:
+                batch_promises.append(ipromise)
 
         # Делаем прогон всех контекстов генерации одним батчем:
-        num_return_sequences = 2
-        chitchat_outputs_batch = self.chitchat.generate_chitchat_batch([promise.generation_promise.chitchat_generation_context for promise in chitchat_promises], num_return_sequences=num_return_sequences)
+        if batch_promises:
+            chitchat_outputs_batch = self.chitchat.generate_chitchat_batch([chitchat_promises[ipromise].generation_promise.chitchat_generation_context for ipromise in batch_promises],
+                                                                           num_return_sequences=num_return_sequences,
+                                                                           tokens_cache=session.dialog.prompt_tokens)
+            for ipromise, chitchat_outputs in zip(batch_promises, chitchat_outputs_batch):
+                promise2outputs[ipromise] = chitchat_outputs
+
+        # Для контекстов, которых не нашлось в пуле, генерируем реплики с запасом, лишние сохраняем в пуле.
+        if pool_miss_promises:
+            pool_miss_contexts = [chitchat_promises[ipromise].generation_promise.chitchat_generation_context for ipromise in pool_miss_promises]
+            if self.chitchat.session_kv_cache is not None and len(pool_miss_contexts) == 1:
+                # Единственный контекст строится из истории диалога, поэтому его начало есть в KV-кэше сессии.
+                # Несколько контекстов выгоднее сгенерировать одним батчем без кэша.
+                chitchat_outputs_batch = [self.chitchat.generate_chitchat(pool_miss_contexts[0],
+                                                                          num_return_sequences=oversample,
+                                                                          tokens_cache=session.dialog.prompt_tokens,
+                                                                          session_id=session.get_interlocutor(),
+                                                                          max_new_tokens=self.chitchat.max_batch_reply_tokens)]
+            else:
+                chitchat_outputs_batch = self.chitchat.generate_chitchat_batch(pool_miss_contexts,
+                                                                               num_return_sequences=oversample,
+                                                                               tokens_cache=session.dialog.prompt_tokens)
+            for ipromise, chitchat_outputs in zip(pool_miss_promises, chitchat_outputs_batch):
+                promise2outputs[ipromise] = chitchat_outputs[:num_return_sequences]
+                self.reply_pool.put(chitchat_promises[ipromise].generation_promise.chitchat_generation_context, chitchat_outputs[num_return_sequences:])
 
         for ipromise, promise in enumerate(chitchat_promises):
-            chitchat_outputs = chitchat_outputs_batch[ipromise*num_return_sequences: (ipromise+1)*num_return_sequences]
+            chitchat_outputs = promise2outputs[ipromise]
             for chitchat_output in chitchat_outputs:
                 # Оценка синтаксической валидности реплики
                 p_valid = 1.0  # self.syntax_validator.is_valid(chitchat_output, text_utils=self.text_utils)
@@ -1239,7 +1532,7 @@ class BotCore:
     def generate_dodge_reply(self, dialog, interpretation, p_interp):
         message_labels = ['уклониться от ответа']
         chitchat_context = dialog.construct_chitchat_context(interpretation, message_labels)
-        chitchat_promise = ResponseGenerationPromise.make_promise(chitchat_context)
+        chitchat_promise = ResponseGenerationPromise.make_promise(chitchat_context, pooled=True)
 
         responses = []
         responses.append(GeneratedResponse('dodge_response@924',
@@ -1253,7 +1546,7 @@ class BotCore:
     def generate_noinfo_reply(self, dialog, interpretation, p_interp):
         message_labels = ['нет информации']
         chitchat_context = dialog.construct_chitchat_context(interpretation, message_labels)
-        chitchat_promise = ResponseGenerationPromise.make_promise(chitchat_context)
+        chitchat_promise = ResponseGenerationPromise.make_promise(chitchat_context, pooled=True)
 
         responses = []
         responses.append(GeneratedResponse('noinfo_response@938',
@@ -1267,7 +1560,7 @@ class BotCore:
     def generate_chitchat_reply(self, dialog, interpretation, p_interp):
         message_labels = []
         chitchat_context = dialog.construct_chitchat_context(interpretation, message_labels)
-        chitchat_promise = ResponseGenerationPromise.make_promise(chitchat_context)
+        chitchat_promise = ResponseGenerationPromise.make_promise(chitchat_context, pooled=True)
 
         responses = []
         responses.append(GeneratedResponse('chitchat_response@952',
@@ -1319,7 +1612,7 @@ class BotCore:
         context_str = ' '.join(context)
 
         chitchat_context = [context_str]
-        chitchat_promise = ResponseGenerationPromise.make_promise(chitchat_context)
+        chitchat_promise = ResponseGenerationPromise.make_promise(chitchat_context, premise_grounded=True)
 
         responses = []
         responses.append(GeneratedResponse('p2qa_response@1004',
@@ -1339,7 +1632,7 @@ class BotCore:
 
         if chitchat_context_str not in processed_chitchat_contexts:
             processed_chitchat_contexts.add(chitchat_context_str)
-            chitchat_promise = ResponseGenerationPromise.make_promise(chitchat_context)
+            chitchat_promise = ResponseGenerationPromise.make_promise(chitchat_context, premise_grounded=True)
             responses.append(GeneratedResponse('pqa_response@1022',
                                                prev_utterance_interpretation=interpretation,
                                                generation_promise=chitchat_promise,
@@ -1354,7 +1647,7 @@ def split_message_text(message, text_utils):
     assertions = []
     questions = []
 
-    for clause in text_utils.split_clauses(message):
+    for clause in text_utils.analyze(message).get_clauses():
         if clause.endswith('?'):
             questions.append(clause)
         else:
@@ -9,6 +9,13 @@
 
 29.01.2021 Генерируемые факты - при чтении строки из профиля она разбивается по символу | и выбирается одна из
            получившихся строк. Таким образом можно вводить вариативность в набор фактов.
+
+19.10.2026 Профиль разбирается один раз в общий для всех сессий неизменяемый снимок ProfileFactsSnapshot,
+           в котором заранее канонизированы все варианты строк с |. Сессия хранит только массив индексов
+           выбранных вариантов.
+
+19.10.2026 Факты, добавленные в ходе диалога, кэшируются в памяти сессии: читаем их из БД один раз,
+           дальше изменения записываются и в БД, и в кэш.
 """
 
 import io
@@ -17,12 +24,129 @@ import os
 import re
 import logging
 import random
-import collections
+import threading
+from array import array
 
 from ruchatbot.bot.simple_facts_storage import SimpleFactsStorage
 from ruchatbot.utils.constant_replacer import replace_constant
 
 
+class ProfileFactsSnapshot(object):
+    """
+    Разобранный файл профиля вместе с импортированными файлами. Хранится в колоночном виде:
+    для каждой строки - id раздела, id файла-источника и варианты текста, полученные разбиением по |.
+    Для каждого варианта заранее построен кортеж (текст, раздел, источник), поэтому сессии при перечислении
+    фактов не создают новых объектов. Экземпляры общие для всех сессий и не модифицируются после создания.
+    """
+    snapshots = dict()
+    snapshots_lock = threading.Lock()
+
+    def __init__(self):
+        self.sections = []  # интернированные названия разделов
+        self.sources = []  # интернированные пути к файлам
+        self.section_ids = array('B')
+        self.source_ids = array('H')
+        self.variants = []  # для каждой строки - кортеж канонизированных вариантов
+        self.fact_variants = ()  # для каждой строки - кортеж фактов (текст, раздел, источник)
+        self.variant_lines = 0  # сколько строк имеют больше одного варианта
+
+    @staticmethod
+    def get_snapshot(profile_path, constants, text_utils):
+        """Вернет общий снимок для профиля, при первом обращении файл будет прочитан и разобран."""
+        key = (profile_path, tuple(sorted(constants.items())))
+        with ProfileFactsSnapshot.snapshots_lock:
+            snapshot = ProfileFactsSnapshot.snapshots.get(key)
+            if snapshot is None:
+                snapshot = ProfileFactsSnapshot.load(profile_path, constants, text_utils)
+                ProfileFactsSnapshot.snapshots[key] = snapshot
+        return snapshot
+
+    @staticmethod
+    def invalidate(profile_path):
+        """Забываем снимки профиля, чтобы при следующем обращении файл был перечитан."""
+        with ProfileFactsSnapshot.snapshots_lock:
+            for key in [key for key in ProfileFactsSnapshot.snapshots.keys() if key[0] == profile_path]:
+                del ProfileFactsSnapshot.snapshots[key]
+
+    @staticmethod
+    def load(profile_path, constants, text_utils):
+        logger = logging.getLogger('ProfileFactsReader')
+        logger.info('Loading profile facts from "%s"', profile_path)
+        snapshot = ProfileFactsSnapshot()
+        if profile_path is not None:
+            with io.open(profile_path, 'r', encoding='utf=8') as rdr:
+                current_section = None
+                for line in rdr:
+                    line = line.strip()
+                    if line:
+                        if line.startswith('#'):
+                            if line.startswith('##'):
+                                if 'profile_section:' in line:
+                                    # Задается раздел баз знаний
+                                    current_section = line[line.index(':')+1:].strip()
+                                    if current_section not in ('1s', '2s', '3'):
+                                        msg = 'Unknown profile section {}'.format(current_section)
+                                        raise RuntimeError(msg)
+                                elif 'import' in line:
+                                    # Читаем факты из дополнительного файла
+                                    fn = re.search('import "(.+)"', line).group(1).strip()
+                                    add_path = os.path.join(os.path.dirname(profile_path), fn)
+                                    logger.debug('Loading facts from file "%s"...', add_path)
+                                    with io.open(add_path, 'rt', encoding='utf-8') as rdr2:
+                                        for line in rdr2:
+                                            line = line.strip()
+                                            if line and not line.startswith('#'):
+                                                snapshot.add_line(line, current_section, add_path, constants, text_utils)
+
+                            else:
+                                # Строки с одним # считаем комментариями.
+                                continue
+                        else:
+                            assert(current_section)
+                            snapshot.add_line(line, current_section, profile_path, constants, text_utils)
+
+        snapshot.fact_variants = tuple(tuple((text, snapshot.sections[section_id], snapshot.sources[source_id]) for text in texts)
+                                       for texts, section_id, source_id
+                                       in zip(snapshot.variants, snapshot.section_ids, snapshot.source_ids))
+        snapshot.variants = tuple(snapshot.variants)
+        snapshot.variant_lines = sum((len(texts) > 1) for texts in snapshot.variants)
+        logger.debug('%d facts loaded from "%s"', len(snapshot), profile_path)
+        return snapshot
+
+    def add_line(self, line, section, source, constants, text_utils):
+        texts = []
+        for line1 in line.split('|'):
+            canonized_line = text_utils.canonize_text(line1.strip())
+            canonized_line = replace_constant(canonized_line, constants, text_utils)
+            texts.append(canonized_line)
+
+        # None в качестве раздела возможен для файлов, импортированных до первой директивы profile_section.
+        if section not in self.sections:
+            self.sections.append(section)
+        if source not in self.sources:
+            self.sources.append(source)
+
+        self.section_ids.append(self.sections.index(section))
+        self.source_ids.append(self.sources.index(source))
+        self.variants.append(tuple(texts))
+
+    def __len__(self):
+        return len(self.variants)
+
+    def choose_variants(self):
+        """Случайный выбор вариантов для строк с |, результат хранится в сессии."""
+        return array('H', [random.randrange(len(texts)) for texts in self.variants if len(texts) > 1])
+
+    def enumerate_facts(self, choices):
+        i = 0
+        for facts in self.fact_variants:
+            if len(facts) == 1:
+                yield facts[0]
+            else:
+                yield facts[choices[i]]
+                i += 1
+
+
 class ProfileFactsReader(SimpleFactsStorage):
     """
     Класс читает факты из одного файла. Новые факты (например, имя собеседника) хранятся только в памяти,
@@ -37,62 +161,36 @@ class ProfileFactsReader(SimpleFactsStorage):
         super(ProfileFactsReader, self).__init__()
         self.text_utils = text_utils
         self.profile_path = profile_path
-        self.profile_facts = None
+        self.profile_snapshot = None  # общий для всех сессий разобранный профиль
+        self.profile_choices = None  # индексы выбранных вариантов для строк профиля с |
         self.constants = constants
         #self.new_facts = collections.defaultdict(list)  # списки новых фактов в привязке к id собеса
         self.facts_db = facts_db
+        self.added_facts = dict()  # id собеседника => список новых фактов (текст, '<<<UNK@107>>>', тэг), копия строк в БД
         self.logger = logging.getLogger('ProfileFactsReader')
 
     def load_profile(self):
-        if self.profile_facts is None:
-            self.logger.info('Loading profile facts from "%s"', self.profile_path)
-            self.profile_facts = []
-            if self.profile_path is not None:
-                with io.open(self.profile_path, 'r', encoding='utf=8') as rdr:
-                    current_section = None
-                    for line in rdr:
-                        line = line.strip()
-                        if line:
-                            if line.startswith('#'):
-                                if line.startswith('##'):
-                                    if 'profile_section:' in line:
-                                        # Задается раздел баз знаний
-                                        current_section = line[line.index(':')+1:].strip()
-                                        if current_section not in ('1s', '2s', '3'):
-                                            msg = 'Unknown profile section {}'.format(current_section)
-                                            raise RuntimeError(msg)
-                                    elif 'import' in line:
-                                        # Читаем факты из дополнительного файла
-                                        fn = re.search('import "(.+)"', line).group(1).strip()
-                                        add_path = os.path.join(os.path.dirname(self.profile_path), fn)
-                                        self.logger.debug('Loading facts from file "%s"...', add_path)
-                                        with io.open(add_path, 'rt', encoding='utf-8') as rdr2:
-                                            for line in rdr2:
-                                                line = line.strip()
-                                                if line and not line.startswith('#'):
-                                                    line1 = random.choice(line.split('|')).strip()
-                                                    canonized_line = self.text_utils.canonize_text(line1)
-                                                    canonized_line = replace_constant(canonized_line, self.constants, self.text_utils)
-                                                    self.profile_facts.append((canonized_line, current_section, add_path))
-
-                                else:
-                                    # Строки с одним # считаем комментариями.
-                                    continue
-                            else:
-                                assert(current_section)
-                                line1 = random.choice(line.split('|')).strip()
-                                canonized_line = self.text_utils.canonize_text(line1)
-                                canonized_line = replace_constant(canonized_line, self.constants, self.text_utils)
-                                self.profile_facts.append((canonized_line, current_section, self.profile_path))
-            self.logger.debug('%d facts loaded from "%s"', len(self.profile_facts), self.profile_path)
+        if self.profile_snapshot is None:
+            self.profile_snapshot = ProfileFactsSnapshot.get_snapshot(self.profile_path, self.constants, self.text_utils)
+            self.profile_choices = self.profile_snapshot.choose_variants()
+
+    def load_added_facts(self, interlocutor):
+        facts = self.added_facts.get(interlocutor)
+        if facts is None:
+            facts = [(fact_text, '<<<UNK@107>>>', fact_tag) for fact_text, fact_tag in self.facts_db.load_facts(interlocutor)]
+            self.added_facts[interlocutor] = facts
+        return facts
 
     def reset_added_facts(self, interlocutor):
         #self.new_facts = collections.defaultdict(list)
         self.facts_db.reset_facts(interlocutor)
+        self.added_facts[interlocutor] = []
 
     def reset_all_facts(self):
         #self.reset_added_facts()
-        self.profile_facts = None
+        ProfileFactsSnapshot.invalidate(self.profile_path)
+        self.profile_snapshot = None
+        self.profile_choices = None
 
     def enumerate_facts(self, interlocutor):
         # Загрузим факты из профиля, если еще не загрузили.
@@ -102,9 +200,8 @@ class ProfileFactsReader(SimpleFactsStorage):
         parent_facts = list(super(ProfileFactsReader, self).enumerate_facts(interlocutor))
 
         # Новые факты, собранные в ходе диалогов с данным собеседником.
-        new_facts = self.facts_db.load_facts(interlocutor)
-        new_facts2 = [(fact_text, '<<<UNK@107>>>', fact_tag) for fact_text, fact_tag in new_facts]
-        for f in itertools.chain(new_facts2, self.profile_facts, parent_facts):
+        new_facts = self.load_added_facts(interlocutor)
+        for f in itertools.chain(new_facts, self.profile_snapshot.enumerate_facts(self.profile_choices), parent_facts):
             yield f
 
     def store_new_fact(self, interlocutor, fact_text, fact_tag, unique):
@@ -114,16 +211,29 @@ class ProfileFactsReader(SimpleFactsStorage):
 
         # Новые факты, добавляемые собеседником в ходе диалога, сохраняем только в оперативке,
         # в других реализациях хранилища будет персистентность.
+        # Кэш обновляем только после успешной записи в БД.
+        facts = self.load_added_facts(interlocutor)
+        new_fact = (fact_text, '<<<UNK@107>>>', fact_tag)
         if unique:
             assert(len(fact_tag) != 0)
             self.facts_db.update_tagged_fact(interlocutor, fact_text, fact_tag)
+            for i, fact in enumerate(facts):
+                if fact[2] == fact_tag:
+                    facts[i] = new_fact
+                    break
+            else:
+                facts.append(new_fact)
         else:
             self.facts_db.store_fact(interlocutor, fact_text, fact_tag)
+            facts.append(new_fact)
 
     def get_added_facts(self, interlocutor):
-        return self.facts_db.load_facts(interlocutor)
+        return [(fact_text, fact_tag) for fact_text, _, fact_tag in self.load_added_facts(interlocutor)]
 
     def find_tagged_fact(self, interlocutor, fact_tag):
         """Среди новых фактов ищем имеющий указанный тэг"""
-        return self.facts_db.find_tagged_fact(interlocutor, fact_tag)
+        for fact_text, _, fact_tag2 in self.load_added_facts(interlocutor):
+            if fact_tag2 == fact_tag:
+                return (fact_text,)
+        return None
 
@@ -0,0 +1,39 @@
+"""
+Кэш результатов токенизации фрагментов промптов в рамках одной диалоговой сессии.
+
+Промпты для gpt-читчата и t5-интерпретатора собираются из реплик истории диалога,
+и от хода к ходу меняется только хвост истории. Поэтому токенизируем каждую реплику
+один раз для каждого токенизатора, а промпт собираем конкатенацией готовых id токенов.
+"""
+
+import collections
+
+
+class PromptTokensCache(object):
+    def __init__(self, max_items=500):
+        """
+        :param max_items: сколько фрагментов храним для каждого токенизатора, старые вытесняются по принципу LRU
+        """
+        self.max_items = max_items
+        self.tokenizer2cache = dict()
+
+    def encode(self, tokenizer_name, tokenizer, text):
+        """Вернет кортеж id токенов для текста, токенизируя его только при первом обращении."""
+        cache = self.tokenizer2cache.get(tokenizer_name)
+        if cache is None:
+            cache = collections.OrderedDict()
+            self.tokenizer2cache[tokenizer_name] = cache
+
+        token_ids = cache.get(text)
+        if token_ids is None:
+            token_ids = tuple(tokenizer.encode(text, add_special_tokens=False))
+            cache[text] = token_ids
+            if len(cache) > self.max_items:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(text)
+
+        return token_ids
+
+    def clear(self):
+        self.tokenizer2cache.clear()
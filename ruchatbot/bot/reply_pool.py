@@ -0,0 +1,96 @@
+"""
+Пул сэмплированных реплик читчата для повторяющихся контекстов генерации.
+
+Ветки уклонения от ответа, "нет информации" и обычного читчата для коротких реплик
+часто строят одинаковый контекст генерации. Поэтому при генерации для такого контекста
+делаем больше сэмплов, чем нужно прямо сейчас, а лишние складываем в пул и выдаем
+при следующих запросах с таким же контекстом, не вызывая gpt-модель. Количество сэмплов задается
+параметром профиля бота reply_pool_oversample (по умолчанию 6), значение не больше количества нужных
+реплик отключает пул.
+
+Для одного контекста хранится ограниченное время (ttl), общее количество
+контекстов в пуле тоже ограничено, лишние вытесняются по принципу LRU.
+"""
+
+import collections
+import random
+import threading
+import time
+
+
+class ReplyPool(object):
+    def __init__(self, max_contexts=1000, ttl=600.0):
+        """
+        :param max_contexts: максимальное количество контекстов генерации в пуле
+        :param ttl: время жизни сгенерированных реплик в секундах
+        """
+        self.max_contexts = max_contexts
+        self.ttl = ttl
+        self.key2samples = collections.OrderedDict()  # контекст => список невыданных реплик (время генерации, реплика)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(context_lines):
+        return '\n'.join(context_lines)
+
+    def draw(self, context_lines, nb_replies, session):
+        """
+        Пробуем взять из пула nb_replies реплик для контекста генерации.
+        Реплики, которые бот уже произносил в этой сессии, не выдаем, чтобы ответы не повторялись.
+        Если в пуле недостаточно подходящих реплик, вернем None, и надо генерировать заново.
+        """
+        key = ReplyPool.make_key(context_lines)
+        with self.lock:
+            samples = self.key2samples.get(key)
+            if samples is not None:
+                # Просроченные реплики выкидываем.
+                min_time = time.time() - self.ttl
+                samples[:] = [sample for sample in samples if sample[0] >= min_time]
+                if len(samples) == 0:
+                    del self.key2samples[key]
+                    samples = None
+
+            if samples is not None:
+                fresh_samples = [sample for sample in samples if session.count_bot_phrase(sample[1]) == 0]
+                if len(fresh_samples) >= nb_replies:
+                    drawn_samples = random.sample(fresh_samples, nb_replies)
+                    for sample in drawn_samples:
+                        samples.remove(sample)
+                    if len(samples) == 0:
+                        del self.key2samples[key]
+                    else:
+                        self.key2samples.move_to_end(key)
+                    self.hits += 1
+                    return [sample[1] for sample in drawn_samples]
+
+            self.misses += 1
+            return None
+
+    def put(self, context_lines, samples):
+        """Добавляем в пул невыданные реплики, сгенерированные для контекста. Дубликаты не сохраняем."""
+        samples = [s for s in samples if s]
+        if not samples:
+            return
+
+        key = ReplyPool.make_key(context_lines)
+        t = time.time()
+        with self.lock:
+            pooled_samples = self.key2samples.get(key)
+            if pooled_samples is None:
+                pooled_samples = []
+                self.key2samples[key] = pooled_samples
+
+            pooled_texts = set(sample[1] for sample in pooled_samples)
+            for s in samples:
+                if s not in pooled_texts:
+                    pooled_samples.append((t, s))
+                    pooled_texts.add(s)
+
+            self.key2samples.move_to_end(key)
+            while len(self.key2samples) > self.max_contexts:
+                self.key2samples.popitem(last=False)
+
+    def __len__(self):
+        return len(self.key2samples)
@@ -3,16 +3,23 @@
 Часть пайплайна чатбота https://github.com/Koziev/chatbot
 
 08.10.2022 Вычисление перплексии модели на диалогах переделано на прогон батчем.
+19.10.2026 Промпты собираются из закэшированных в диалоговой сессии id токенов реплик (см. PromptTokensCache).
+19.10.2026 Опциональное спекулятивное декодирование с черновиками из промпта (prompt lookup) для ответов по предпосылкам.
+19.10.2026 Опциональный KV-кэш истории диалога для каждой сессии (см. SessionKVCache).
+19.10.2026 Пакетная генерация: одинаковые контексты генерируются один раз, батч режется на части по бюджету токенов.
 """
 
 import logging.handlers
 import math
 import os.path
+import sys
 
 import torch
 from transformers import GPT2LMHeadModel, GPT2Tokenizer
 from torch.nn import CrossEntropyLoss
 
+from ruchatbot.bot.session_kv_cache import SessionKVCache, to_legacy_past, to_model_past
+
 
 def pad_tokens(tokens, max_len):
     l = len(tokens)
@@ -29,6 +36,22 @@ class RugptChitChat:
         self.top_k = 30
         self.top_p = 0.9
         self.repetition_penalty = 1.2
+        self.max_reply_tokens = 80  # макс. длина реплики в токенах при генерации для одного контекста
+        self.max_batch_reply_tokens = 60  # то же для пакетной генерации
+        self.max_batch_tokens = 8192  # бюджет для пакетной генерации: кол-во строк (с учетом num_return_sequences) * длина промпта с паддингом
+        self.incremental_tokenization = False  # можно ли собирать промпт из отдельно токенизированных реплик
+        self.special_tokens_split = False  # <s> и </s> токенизируются как спецтокены
+
+        # Спекулятивное декодирование с черновиками, которые берутся из промпта по совпадению n-грамм.
+        # Ответы по предпосылкам часто копируют куски текста предпосылки, поэтому за один прогон модели
+        # удается принять несколько токенов.
+        self.prompt_lookup_decoding = False
+        self.prompt_lookup_ngram = 3  # макс. длина n-граммы для поиска черновика
+        self.prompt_lookup_draft_len = 10  # макс. длина черновика
+        self.stop_token_ids = dict()  # кэш проверки токенов на завершение реплики
+
+        # KV-кэши префиксов промптов для диалоговых сессий, по умолчанию отключены.
+        self.session_kv_cache = None
 
     def load(self, model_name_or_path):
         self.tokenizer = GPT2Tokenizer.from_pretrained(model_name_or_path)
@@ -36,26 +59,133 @@ class RugptChitChat:
         self.model.to(self.device)
         self.model.eval()
 
-    def generate_chitchat(self, context_replies, num_return_sequences):
-        return self.generate_output(context_replies, num_return_sequences)
+        # Проверяем, что токенизация промпта по частям дает те же токены, что и токенизация целиком.
+        probe_lines = ['Привет, как дела?', 'Нормально. А у тебя?', 'Меня зовут Вика... 123!']
+        whole_ids = self.tokenizer.encode(self.prepare_prompt(probe_lines), add_special_tokens=False)
+        self.incremental_tokenization = whole_ids == self.encode_prompt(probe_lines, None, force_incremental=True)
+        if not self.incremental_tokenization:
+            self.logger.warning('Incremental prompt tokenization is disabled: tokenizer splits prompt fragments differently')
+
+        self.special_tokens_split = all((t in self.tokenizer.all_special_tokens) for t in ['<s>', '</s>'])
+
+    def enable_session_kv_cache(self, max_tokens):
+        self.session_kv_cache = SessionKVCache(max_tokens=max_tokens)
+
+    def generate_chitchat(self, context_replies, num_return_sequences, tokens_cache=None, session_id=None, max_new_tokens=None):
+        if session_id is not None and self.session_kv_cache is not None:
+            # Начало промпта совпадает с предыдущими ходами диалога, его KV-кэш берем из сессии.
+            self.logger.debug('Generating chit-chat response with session KV cache, context=〚%s〛', ' | '.join(context_replies))
+            prompt_ids = self.encode_prompt(context_replies, tokens_cache)
+            return self.generate_with_session_past(prompt_ids, num_return_sequences, session_id, max_new_tokens=max_new_tokens)
+
+        return self.generate_output(context_replies, num_return_sequences, tokens_cache=tokens_cache, max_new_tokens=max_new_tokens)
 
     def prepare_prompt(self, lines):
         prompt_text = '\n'.join(('- '+line) for line in lines) + '\n-'
         return prompt_text
 
-    def generate_chitchat_batch(self, contexts, num_return_sequences):
-        prompts = [self.prepare_prompt(lines) for lines in contexts]
+    def encode_fragment(self, text, tokens_cache):
+        if tokens_cache is None:
+            return self.tokenizer.encode(text, add_special_tokens=False)
+        else:
+            return tokens_cache.encode('rugpt_chitchat', self.tokenizer, text)
+
+    def encode_prompt(self, lines, tokens_cache, force_incremental=False):
+        """
+        Возвращает список id токенов для промпта prepare_prompt(lines).
+        Каждая реплика и разделители токенизируются отдельно, поэтому при наличии кэша
+        заново токенизируется только новый текст.
+        """
+        if not self.incremental_tokenization and not force_incremental:
+            return self.tokenizer.encode(self.prepare_prompt(lines), add_special_tokens=False)
+
+        token_ids = []
+        for iline, line in enumerate(lines):
+            if iline > 0:
+                token_ids.extend(self.encode_fragment('\n', tokens_cache))
+            token_ids.extend(self.encode_fragment('- ' + line, tokens_cache))
+        token_ids.extend(self.encode_fragment('\n', tokens_cache))
+        token_ids.extend(self.encode_fragment('-', tokens_cache))
+        return token_ids
+
+    def encode_dialog(self, dialog, tokens_cache):
+        """Токенизация диалога для score_dialogues"""
+        if tokens_cache is None or not self.incremental_tokenization or not self.special_tokens_split:
+            return self.tokenizer.encode('<s>' + '\n'.join(dialog) + '</s>')
+
+        token_ids = list(self.encode_fragment('<s>', tokens_cache))
+        for iline, line in enumerate(dialog):
+            if iline > 0:
+                token_ids.extend(self.encode_fragment('\n', tokens_cache))
+            token_ids.extend(self.encode_fragment(line, tokens_cache))
+        token_ids.extend(self.encode_fragment('</s>', tokens_cache))
+        return token_ids
+
+    def pad_prompts_left(self, prompts_ids):
+        """Выравниваем промпты по длине, добавляя pad-токены слева, как для tokenizer.padding_side='left'."""
+        pad_token_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else 0
+        max_len = max(map(len, prompts_ids))
+        input_ids = [[pad_token_id] * (max_len - len(ids)) + list(ids) for ids in prompts_ids]
+        attention_mask = [[0] * (max_len - len(ids)) + [1] * len(ids) for ids in prompts_ids]
+        input_ids = torch.tensor(input_ids, dtype=torch.long, device=self.device)
+        attention_mask = torch.tensor(attention_mask, dtype=torch.long, device=self.device)
+        return input_ids, attention_mask
+
+    def decode_continuation(self, generated_sequence, prompt_len, stop_token):
+        """Декодируем только сгенерированные после промпта токены и вырезаем из них первую реплику."""
+        text = self.tokenizer.decode(generated_sequence[prompt_len:], clean_up_tokenization_spaces=True)
+        if stop_token in text:
+            text = text[: text.find(stop_token)]
+
+        total_sequence = text
+        if total_sequence.startswith('- '):
+            total_sequence = total_sequence[1:]
+
+        if '\n' in total_sequence:
+            total_sequence = total_sequence[:total_sequence.index('\n')]
+
+        return total_sequence.strip()
+
+    def generate_chitchat_batch(self, contexts, num_return_sequences, tokens_cache=None, max_new_tokens=None):
+        """
+        Генерация реплик для нескольких контекстов одним батчем.
+        Возвращается список списков: для каждого контекста - уникальные сгенерированные реплики.
+
+        max_new_tokens - макс. длина реплики, по умолчанию max_batch_reply_tokens.
+
+        Одинаковые контексты генерируются один раз. Остальные сортируются по длине и режутся на
+        подбатчи так, чтобы кол-во строк * длина промпта с паддингом не превышало max_batch_tokens,
+        тогда один длинный контекст не раздувает паддинг всего батча.
+        """
+        prompts_ids = [tuple(self.encode_prompt(lines, tokens_cache)) for lines in contexts]
+
+        unique_prompts = sorted(set(prompts_ids), key=len)
+        prompt2outputs = dict()
+        batch = []
+        for prompt_ids in unique_prompts:
+            # Промпты отсортированы по возрастанию длины, так что длина с паддингом равна длине текущего промпта.
+            if batch and (len(batch) + 1) * num_return_sequences * len(prompt_ids) > self.max_batch_tokens:
+                prompt2outputs.update(zip(batch, self.generate_padded_batch(batch, num_return_sequences, max_new_tokens)))
+                batch = []
+            batch.append(prompt_ids)
+
+        if batch:
+            prompt2outputs.update(zip(batch, self.generate_padded_batch(batch, num_return_sequences, max_new_tokens)))
+
+        return [list(prompt2outputs[prompt_ids]) for prompt_ids in prompts_ids]
+
+    def generate_padded_batch(self, prompts_ids, num_return_sequences, max_new_tokens=None):
+        """Генерация одним вызовом model.generate для выровненных слева промптов."""
         stop_token = "</s>"
-        length = 60
+        length = max_new_tokens if max_new_tokens is not None else self.max_batch_reply_tokens
 
-        self.tokenizer.padding_side = 'left'  # вернуть потом назад?
-        encoded_prompts = self.tokenizer(prompts, add_special_tokens=False, return_tensors="pt", padding='longest')
-        encoded_prompts = encoded_prompts.to(self.device)
+        input_ids, attention_mask = self.pad_prompts_left(prompts_ids)
+        prompt_len = input_ids.shape[1]
 
         output_sequences = self.model.generate(
-            input_ids=encoded_prompts.input_ids,
-            attention_mask=encoded_prompts.attention_mask,
-            max_length=length + len(encoded_prompts.input_ids[0]),
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            max_length=length + prompt_len,
             temperature=self.temperature,
             top_k=self.top_k,
             top_p=self.top_p,
@@ -69,39 +199,26 @@ class RugptChitChat:
         if len(output_sequences.shape) > 2:
             output_sequences.squeeze_()
 
-        generated_sequences = set()
+        # Результаты генерации группируем по промптам, чтобы вызывающий код мог сопоставить
+        # сгенерированные реплики с исходными контекстами.
+        generated_sequences = [[] for _ in prompts_ids]
         for generated_sequence_idx, generated_sequence in enumerate(output_sequences):
             generated_sequence = generated_sequence.tolist()
-
-            text = self.tokenizer.decode(generated_sequence, clean_up_tokenization_spaces=True)
-            if stop_token in text:
-                text = text[: text.find(stop_token)]
-
             iprompt = generated_sequence_idx // num_return_sequences
-            total_sequence = text[len(self.tokenizer.decode(encoded_prompts.input_ids[iprompt], clean_up_tokenization_spaces=True)):]
-            if total_sequence.startswith('- '):
-                total_sequence = total_sequence[1:]
+            total_sequence = self.decode_continuation(generated_sequence, prompt_len, stop_token)
+            if total_sequence not in generated_sequences[iprompt]:
+                generated_sequences[iprompt].append(total_sequence)
 
-            if '\n' in total_sequence:
-                total_sequence = total_sequence[:total_sequence.index('\n')]
-
-            total_sequence = total_sequence.strip()
-            generated_sequences.add(total_sequence)
+        self.logger.debug('Chit-chat generated %d responses in batch: 〚%s〛', sum(map(len, generated_sequences)), ' | '.join(' | '.join(outputs) for outputs in generated_sequences))
+        return generated_sequences
 
-        generated_sequences = list(generated_sequences)
-        self.logger.debug('Chit-chat generated %d responses in batch: 〚%s〛', len(generated_sequences), ' | '.join(generated_sequences))
-        return list(generated_sequences)
-
-    def generate_output(self, lines, num_return_sequences=10):
+    def generate_output(self, lines, num_return_sequences=10, tokens_cache=None, max_new_tokens=None):
         self.logger.debug('Generating chit-chat response with context=〚%s〛', ' | '.join(lines))
 
-        prompt_text = self.prepare_prompt(lines)
-
         stop_token = "</s>"
-        length = 80
+        length = max_new_tokens if max_new_tokens is not None else self.max_reply_tokens
 
-        encoded_prompt = self.tokenizer.encode(prompt_text, add_special_tokens=False, return_tensors="pt")
-        encoded_prompt = encoded_prompt.to(self.device)
+        encoded_prompt = torch.tensor([self.encode_prompt(lines, tokens_cache)], dtype=torch.long, device=self.device)
 
         output_sequences = self.model.generate(
             input_ids=encoded_prompt,
@@ -122,29 +239,235 @@ class RugptChitChat:
         generated_sequences = set()
         for generated_sequence_idx, generated_sequence in enumerate(output_sequences):
             generated_sequence = generated_sequence.tolist()
+            total_sequence = self.decode_continuation(generated_sequence, len(encoded_prompt[0]), stop_token)
+            generated_sequences.add(total_sequence)
 
-            text = self.tokenizer.decode(generated_sequence, clean_up_tokenization_spaces=True)
-            if stop_token in text:
-                text = text[: text.find(stop_token)]
-
-            total_sequence = text[len(self.tokenizer.decode(encoded_prompt[0], clean_up_tokenization_spaces=True)):]
-            if total_sequence.startswith('- '):
-                total_sequence = total_sequence[1:]
+        self.logger.debug('Chit-chat generated %d responses: %s', len(generated_sequences), '; '.join(generated_sequences))
+        return list(generated_sequences)
 
-            if '\n' in total_sequence:
-                total_sequence = total_sequence[:total_sequence.index('\n')]
+    def generate_prompt_lookup(self, lines, num_return_sequences=1, tokens_cache=None, max_new_tokens=None, do_sample=True, session_id=None):
+        """
+        Генерация реплик спекулятивным декодированием без модели-черновика: черновик продолжения
+        ищется как продолжение последней n-граммы в промпте и уже сгенерированном тексте, затем весь
+        черновик проверяется одним прогоном модели и принимается его самый длинный подходящий префикс.
+        Распределение результатов совпадает с обычным сэмплированием (или жадным поиском при do_sample=False).
+        """
+        self.logger.debug('Generating chit-chat response with prompt lookup decoding, context=〚%s〛', ' | '.join(lines))
+        prompt_ids = self.encode_prompt(lines, tokens_cache)
+        if max_new_tokens is None:
+            # Такие ответы раньше генерировались пакетно, поэтому и длина та же.
+            max_new_tokens = self.max_batch_reply_tokens
+
+        generated_sequences = []
+        for _ in range(num_return_sequences):
+            new_ids = self.decode_prompt_lookup(prompt_ids, max_new_tokens, do_sample, session_id=session_id)
+            total_sequence = self.decode_continuation(new_ids, 0, '</s>')
+            if total_sequence not in generated_sequences:
+                generated_sequences.append(total_sequence)
+
+        return generated_sequences
+
+    def find_draft_tokens(self, token_ids, num_draft_tokens):
+        """Ищем предыдущее вхождение хвостовой n-граммы и возвращаем токены после него в качестве черновика."""
+        for n in range(self.prompt_lookup_ngram, 0, -1):
+            if len(token_ids) <= n:
+                continue
+
+            tail = token_ids[-n:]
+            for start in range(len(token_ids) - n - 1, -1, -1):
+                if token_ids[start: start + n] == tail:
+                    draft = token_ids[start + n: start + n + num_draft_tokens]
+                    if draft:
+                        return draft
+
+        return []
+
+    def is_stop_token(self, token_id):
+        """Реплика заканчивается на </s> или переводе строки."""
+        is_stop = self.stop_token_ids.get(token_id)
+        if is_stop is None:
+            is_stop = token_id == self.tokenizer.eos_token_id or '\n' in self.tokenizer.decode([token_id])
+            self.stop_token_ids[token_id] = is_stop
+        return is_stop
+
+    def next_token_probs(self, logits, prev_ids):
+        """Те же преобразования логитов, что и в model.generate: repetition penalty, temperature, top-k, top-p"""
+        logits = logits.clone()
+        if self.repetition_penalty != 1.0 and prev_ids:
+            ids = torch.tensor(list(prev_ids), dtype=torch.long, device=logits.device)
+            score = logits[ids]
+            logits[ids] = torch.where(score < 0, score * self.repetition_penalty, score / self.repetition_penalty)
+
+        logits = logits / self.temperature
+
+        if self.top_k > 0:
+            kth_value = torch.topk(logits, min(self.top_k, logits.shape[-1])).values[-1]
+            logits[logits < kth_value] = -float('inf')
+
+        if self.top_p < 1.0:
+            sorted_logits, sorted_indices = torch.sort(logits, descending=False)
+            cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+            sorted_to_remove = cumulative_probs <= (1.0 - self.top_p)
+            sorted_to_remove[-1] = False
+            logits[sorted_indices[sorted_to_remove]] = -float('inf')
+
+        return torch.softmax(logits, dim=-1)
+
+    @staticmethod
+    def crop_past(past_key_values, length):
+        """Оставляем в KV-кэше первые length позиций."""
+        if hasattr(past_key_values, 'crop'):
+            nb_removed = past_key_values.get_seq_length() - length
+            if nb_removed > 0:
+                past_key_values.crop(-nb_removed)
+            return past_key_values
+        return tuple((k[:, :, :length, :], v[:, :, :length, :]) for k, v in past_key_values)
+
+    def prime_past(self, prompt_ids, session_id):
+        """
+        Вернет KV-кэш для промпта без последнего токена и его длину.
+        Если включен кэш сессий, то через модель прогоняются только токены после общего префикса
+        с предыдущим промптом этой сессии, а результат запоминается для следующих ходов.
+        """
+        prefix_ids = prompt_ids[:-1]
+        past_len = 0
+        legacy_past = None
+        if session_id is not None and self.session_kv_cache is not None:
+            past_len, legacy_past = self.session_kv_cache.lookup(session_id, prefix_ids)
+
+        past_key_values = to_model_past(legacy_past)
+        if past_len < len(prefix_ids):
+            o = self.model(input_ids=torch.tensor([prefix_ids[past_len:]], dtype=torch.long, device=self.device),
+                           past_key_values=past_key_values,
+                           use_cache=True)
+            self.logger.debug('KV cache: %d prompt tokens reused, %d tokens encoded', past_len, len(prefix_ids) - past_len)
+            past_key_values = o.past_key_values
+            past_len = len(prefix_ids)
+            if session_id is not None and self.session_kv_cache is not None:
+                self.session_kv_cache.store(session_id, prefix_ids, past_key_values)
+
+        return past_key_values, past_len
+
+    def generate_with_session_past(self, prompt_ids, num_return_sequences, session_id, max_new_tokens=None):
+        """
+        Сэмплирование num_return_sequences продолжений промпта через model.generate, начало промпта
+        берется из KV-кэша сессии. Все строки сэмплируются одним батчем, распределение то же, что и в generate_output.
+        """
+        stop_token = "</s>"
+        if max_new_tokens is None:
+            # Заменяет generate_output, поэтому длина реплики та же.
+            max_new_tokens = self.max_reply_tokens
 
-            total_sequence = total_sequence.strip()
-            generated_sequences.add(total_sequence)
+        n = num_return_sequences
+        with torch.no_grad():
+            past_key_values, past_len = self.prime_past(prompt_ids, session_id)
+            if past_key_values is not None:
+                # model.generate не размножает переданный кэш для num_return_sequences, поэтому
+                # делаем n строк промпта и n копий кэша сами.
+                legacy_past = to_legacy_past(past_key_values)
+                past_key_values = to_model_past(tuple((k.repeat(n, 1, 1, 1), v.repeat(n, 1, 1, 1)) for k, v in legacy_past))
+
+            input_ids = torch.tensor([prompt_ids] * n, dtype=torch.long, device=self.device)
+            output_sequences = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                past_key_values=past_key_values,
+                max_new_tokens=max_new_tokens,
+                temperature=self.temperature,
+                top_k=self.top_k,
+                top_p=self.top_p,
+                repetition_penalty=self.repetition_penalty,
+                do_sample=True,
+                pad_token_id=0
+            )
+
+        generated_sequences = []
+        for generated_sequence in output_sequences:
+            total_sequence = self.decode_continuation(generated_sequence.tolist(), len(prompt_ids), stop_token)
+            if total_sequence not in generated_sequences:
+                generated_sequences.append(total_sequence)
 
         self.logger.debug('Chit-chat generated %d responses: %s', len(generated_sequences), '; '.join(generated_sequences))
-        return list(generated_sequences)
+        return generated_sequences
+
+    def decode_prompt_lookup(self, prompt_ids, max_new_tokens, do_sample, session_id=None):
+        """Декодирование одной последовательности, возвращает список сгенерированных id токенов."""
+        token_ids = list(prompt_ids)
+        generated_ids = []
+        nb_model_calls = 0
 
-    def score_dialogues(self, dialogues):
+        with torch.no_grad():
+            # KV-кэш для промпта без последнего токена; последний токен подается в модель вместе с черновиком.
+            past_key_values, past_len = self.prime_past(token_ids, session_id)
+
+            while len(generated_ids) < max_new_tokens:
+                draft = self.find_draft_tokens(token_ids, min(self.prompt_lookup_draft_len, max_new_tokens - len(generated_ids) - 1))
+                block = [token_ids[-1]] + draft
+                o = self.model(input_ids=torch.tensor([block], dtype=torch.long, device=self.device),
+                               past_key_values=past_key_values,
+                               use_cache=True)
+                nb_model_calls += 1
+                logits = o.logits[0]
+                past_key_values = o.past_key_values
+
+                # Проверяем токены черновика слева направо, пока они согласуются с моделью.
+                prev_ids = set(token_ids)
+                nb_accepted = 0
+                new_token = None
+                finished = False
+                for draft_token in draft:
+                    probs = self.next_token_probs(logits[nb_accepted], prev_ids)
+                    if do_sample:
+                        accepted = torch.rand(1).item() < probs[draft_token].item()
+                    else:
+                        accepted = torch.argmax(probs).item() == draft_token
+
+                    if not accepted:
+                        # Выбираем токен из остаточного распределения без отвергнутого токена черновика.
+                        if do_sample:
+                            residual_probs = probs.clone()
+                            residual_probs[draft_token] = 0.0
+                            if residual_probs.sum().item() > 0.0:
+                                probs = residual_probs / residual_probs.sum()
+                            new_token = torch.multinomial(probs, 1).item()
+                        else:
+                            new_token = torch.argmax(probs).item()
+                        break
+
+                    nb_accepted += 1
+                    token_ids.append(draft_token)
+                    generated_ids.append(draft_token)
+                    prev_ids.add(draft_token)
+                    if self.is_stop_token(draft_token):
+                        finished = True
+                        break
+
+                past_len += 1 + nb_accepted
+                past_key_values = self.crop_past(past_key_values, past_len)
+                if finished:
+                    break
+
+                if new_token is None:
+                    # Весь черновик принят, следующий токен берем из распределения после последнего токена черновика.
+                    probs = self.next_token_probs(logits[nb_accepted], prev_ids)
+                    if do_sample:
+                        new_token = torch.multinomial(probs, 1).item()
+                    else:
+                        new_token = torch.argmax(probs).item()
+
+                token_ids.append(new_token)
+                generated_ids.append(new_token)
+                if self.is_stop_token(new_token):
+                    break
+
+        self.logger.debug('Prompt lookup decoding: %d tokens generated in %d model calls', len(generated_ids), nb_model_calls)
+        return generated_ids
+
+    def score_dialogues(self, dialogues, tokens_cache=None):
         """ Вычисляем перплексию множества диалогов одним батчем """
         scores = []
 
-        encoded_texts = [self.tokenizer.encode('<s>' + '\n'.join(dialog) + '</s>') for dialog in dialogues]
+        encoded_texts = [self.encode_dialog(dialog, tokens_cache) for dialog in dialogues]
         max_len = max(map(len, encoded_texts))
         padded_texts = [pad_tokens(tokens, max_len) for tokens in encoded_texts]
         input_ids = torch.tensor(padded_texts, dtype=torch.long, device=self.device)
@@ -168,11 +491,137 @@ class RugptChitChat:
         return scores
 
 
+class CheckTokenizer:
+    # Для проверок на модели со случайными весами нужны только id конца реплики и декодирование без переводов строки.
+    eos_token_id = 1
+    pad_token_id = 0
+
+    def decode(self, token_ids, clean_up_tokenization_spaces=True):
+        return ' '.join(map(str, token_ids))
+
+
+def check_prompt_lookup(nb_prompts=20):
+    """
+    Сверка prompt lookup декодирования с model.generate на крошечной GPT2 модели со случайными весами (CPU):
+    1) next_token_probs совпадает с logits processors из transformers,
+    2) жадный prompt lookup (в том числе с KV-кэшем сессии) дает те же токены, что и generate(do_sample=False).
+    """
+    import random
+    from transformers import GPT2Config, LogitsProcessorList, RepetitionPenaltyLogitsProcessor, \
+        TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+
+    torch.manual_seed(1)
+    random.seed(1)
+    config = GPT2Config(vocab_size=64, n_positions=256, n_embd=32, n_layer=2, n_head=2, bos_token_id=0, eos_token_id=1)
+    chitchat = RugptChitChat()
+    chitchat.device = torch.device('cpu')
+    chitchat.tokenizer = CheckTokenizer()
+    chitchat.model = GPT2LMHeadModel(config)
+    chitchat.model.eval()
+    chitchat.temperature = 0.8
+    chitchat.enable_session_kv_cache(max_tokens=10000)
+
+    processors = LogitsProcessorList([RepetitionPenaltyLogitsProcessor(chitchat.repetition_penalty),
+                                      TemperatureLogitsWarper(chitchat.temperature),
+                                      TopKLogitsWarper(chitchat.top_k),
+                                      TopPLogitsWarper(chitchat.top_p)])
+    for _ in range(100):
+        input_ids = torch.randint(2, config.vocab_size, (1, 12))
+        logits = torch.randn(1, config.vocab_size)
+        expected = torch.softmax(processors(input_ids, logits.clone()), dim=-1)[0]
+        probs = chitchat.next_token_probs(logits[0], set(input_ids[0].tolist()))
+        assert torch.allclose(probs, expected, atol=1e-6), (probs, expected)
+
+    for iprompt in range(nb_prompts):
+        # В промпте есть повторы, чтобы черновики находились и частично принимались.
+        fragment = [random.randint(2, config.vocab_size - 1) for _ in range(8)]
+        prompt_ids = fragment + [random.randint(2, config.vocab_size - 1) for _ in range(4)] + fragment[:3]
+        max_new_tokens = chitchat.max_batch_reply_tokens
+
+        with torch.no_grad():
+            output = chitchat.model.generate(input_ids=torch.tensor([prompt_ids], dtype=torch.long),
+                                             attention_mask=torch.ones(1, len(prompt_ids), dtype=torch.long),
+                                             max_new_tokens=max_new_tokens,
+                                             do_sample=False,
+                                             repetition_penalty=chitchat.repetition_penalty,
+                                             eos_token_id=config.eos_token_id,
+                                             pad_token_id=0)
+        expected_ids = output[0, len(prompt_ids):].tolist()
+
+        new_ids = chitchat.decode_prompt_lookup(prompt_ids, max_new_tokens, do_sample=False)
+        assert new_ids == expected_ids, (iprompt, new_ids, expected_ids)
+
+        # С кэшем сессии: первый прогон заполняет KV-кэш промпта, второй берет префикс из кэша.
+        for _ in range(2):
+            new_ids = chitchat.decode_prompt_lookup(prompt_ids, max_new_tokens, do_sample=False, session_id='check')
+            assert new_ids == expected_ids, (iprompt, new_ids, expected_ids)
+
+    # Генерация с KV-кэшем сессии через model.generate: при top_k=1 сэмплирование детерминировано
+    # и должно совпадать с генерацией по полному промпту без кэша.
+    chitchat.top_k = 1
+    for iprompt in range(nb_prompts):
+        prompt_ids = [random.randint(2, config.vocab_size - 1) for _ in range(10 + iprompt)]
+        with torch.no_grad():
+            expected = chitchat.generate_padded_batch([prompt_ids], num_return_sequences=3)[0]
+        for _ in range(2):
+            outputs = chitchat.generate_with_session_past(prompt_ids, 3, session_id='check', max_new_tokens=chitchat.max_batch_reply_tokens)
+            assert outputs == expected, (iprompt, outputs, expected)
+
+    print('Prompt lookup decoding and session KV cache generation match model.generate on {} prompts'.format(nb_prompts))
+
+
+def benchmark_session_kv_cache(nb_turns=12, num_return_sequences=4):
+    """
+    Сравнение времени генерации для растущего диалога одной сессии (GPT2 со случайными весами, размер
+    порядка rugpt small по ширине, CPU): пакетная генерация по полному промпту против генерации с KV-кэшем сессии.
+    """
+    import random
+    import time
+    from transformers import GPT2Config
+
+    torch.manual_seed(1)
+    random.seed(1)
+    config = GPT2Config(vocab_size=5000, n_positions=1024, n_embd=768, n_layer=6, n_head=12, bos_token_id=0, eos_token_id=1)
+    chitchat = RugptChitChat()
+    chitchat.device = torch.device('cpu')
+    chitchat.tokenizer = CheckTokenizer()
+    chitchat.model = GPT2LMHeadModel(config)
+    chitchat.model.eval()
+    chitchat.enable_session_kv_cache(max_tokens=100000)
+
+    dialog_ids = []
+    batch_time = 0.0
+    kv_time = 0.0
+    for iturn in range(nb_turns):
+        # Каждый ход добавляет в диалог две реплики примерно по 20 токенов.
+        dialog_ids.extend(random.randint(2, config.vocab_size - 1) for _ in range(40))
+
+        t0 = time.time()
+        with torch.no_grad():
+            chitchat.generate_padded_batch([dialog_ids], num_return_sequences)
+        batch_time += time.time() - t0
+
+        t0 = time.time()
+        chitchat.generate_with_session_past(dialog_ids, num_return_sequences, session_id='benchmark', max_new_tokens=chitchat.max_batch_reply_tokens)
+        kv_time += time.time() - t0
+
+    print('{} turns, prompt grows to {} tokens, {} sequences x {} new tokens: batched generate {:.2f} sec, session KV cache {:.2f} sec'.format(
+        nb_turns, len(dialog_ids), num_return_sequences, chitchat.max_batch_reply_tokens, batch_time, kv_time))
+
+
 if __name__ == '__main__':
-    # Интерактивная проверка модели читчата в консоли, в автономном режиме.
     logging.basicConfig()
     logging.getLogger().setLevel(logging.ERROR)
 
+    if sys.argv[1:] == ['--check_prompt_lookup']:
+        check_prompt_lookup()
+        exit(0)
+
+    if sys.argv[1:] == ['--benchmark_session_kv_cache']:
+        benchmark_session_kv_cache()
+        exit(0)
+
+    # Интерактивная проверка модели читчата в консоли, в автономном режиме.
     chitchat = RugptChitChat()
     chitchat.load(os.path.expanduser('~/polygon/chatbot/tmp/rugpt_npqa'))
 
@@ -1,24 +1,40 @@
 """
 Обертка для использования модели Incomplete Utterance Restoration на базе отфайнтбненной ruT5 в чатботе.
+
+19.10.2026 LRU-кэш интерпретаций для повторяющихся контекстов ("привет", "а тебя?" и т.д.), в T5 идут только промахи.
+           Размер кэша задается в конструкторе (BotCore.interpretation_cache_size), 0 - кэш отключен.
+           Записи кэша живут ограниченное время (BotCore.interpretation_cache_ttl), чтобы для частых контекстов
+           периодически сэмплировались новые варианты интерпретации.
 """
 
 import logging
 import os
+import random
+import re
+import time
 
 import torch
 from transformers import T5ForConditionalGeneration, T5Tokenizer
 
 from ruchatbot.bot.base_utterance_interpreter2 import BaseUtteranceInterpreter2
+from ruchatbot.utils.lru_cache import LruCache
 
 
 class RuT5Interpreter(BaseUtteranceInterpreter2):
-    def __init__(self, device=None):
+    def __init__(self, device=None, cache_size=10000, cache_ttl=600.0):
+        """
+        :param cache_size: сколько контекстов хранить в кэше интерпретаций, 0 - кэш отключен
+        :param cache_ttl: время жизни записи в кэше интерпретаций в секундах
+        """
         BaseUtteranceInterpreter2.__init__(self)
         if device is None:
             use_cuda = torch.cuda.is_available()
             self.device = torch.device("cuda" if use_cuda else "cpu")
         else:
             self.device = device
+        self.incremental_tokenization = False  # можно ли собирать вход модели из отдельно токенизированных реплик
+        self.interpretation_cache = LruCache(max_size=cache_size)  # нормализованный контекст => (время генерации, кол-во сэмплов, список вариантов интерпретации)
+        self.interpretation_cache_ttl = cache_ttl
 
     def load(self, models_dir):
         BaseUtteranceInterpreter2.load(self, models_dir)
@@ -29,10 +45,94 @@ class RuT5Interpreter(BaseUtteranceInterpreter2):
         self.model.to(self.device)
         self.model.eval()
 
-    def interpret(self, phrases, num_return_sequences):
-        t5_input = '\n'.join(('- ' + f) for f in phrases)
-        input_ids = self.tokenizer(t5_input, return_tensors='pt').input_ids.to(self.device)
+        # Проверяем, что токенизация контекста по репликам дает те же токены, что и токенизация целиком.
+        probe_phrases = ['Привет, как дела?', 'Нормально. А у тебя?', 'Меня зовут Вика... 123!']
+        whole_ids = self.tokenizer('\n'.join(('- ' + f) for f in probe_phrases)).input_ids
+        self.incremental_tokenization = whole_ids == self.encode_input(probe_phrases, None, force_incremental=True)
+        if not self.incremental_tokenization:
+            self.logger.warning('T5 Interpreter: incremental tokenization is disabled, tokenizer splits context fragments differently')
+
+    def encode_input(self, phrases, tokens_cache, force_incremental=False):
+        """
+        Вернет список id токенов входа модели для реплик контекста.
+        Реплики токенизируются по отдельности, поэтому при наличии кэша сессии токенизируется только новый текст.
+        """
+        if not self.incremental_tokenization and not force_incremental:
+            t5_input = '\n'.join(('- ' + f) for f in phrases)
+            return self.tokenizer(t5_input).input_ids
+
+        token_ids = []
+        for phrase in phrases:
+            if tokens_cache is None:
+                token_ids.extend(self.tokenizer.encode('- ' + phrase, add_special_tokens=False))
+            else:
+                token_ids.extend(tokens_cache.encode('t5_interpreter', self.tokenizer, '- ' + phrase))
+        token_ids.append(self.tokenizer.eos_token_id)
+        return token_ids
+
+    def interpret(self, phrases, num_return_sequences, tokens_cache=None):
+        return self.interpret_batch([phrases], num_return_sequences, tokens_cache=tokens_cache)[0]
+
+    @staticmethod
+    def make_cache_key(phrases):
+        """
+        Ключ кэша интерпретаций - реплики контекста без лишних пробелов.
+        Регистр и пунктуацию не трогаем, так как модель переносит их в интерпретацию.
+        """
+        return tuple(re.sub(r'\s+', ' ', phrase).strip() for phrase in phrases)
+
+    def interpret_batch(self, contexts, num_return_sequences, tokens_cache=None):
+        """
+        Интерпретация нескольких контекстов за один прогон энкодера и одно сэмплирование.
+        contexts - список контекстов, каждый контекст - список реплик.
+        Вернет для каждого контекста список уникальных вариантов интерпретации.
+        Контексты, для которых в кэше есть варианты интерпретации, в модель не передаются.
+        Промахи сэмплируются с тем же num_return_sequences, что и без кэша. Запись в кэше используется
+        только запросами, которым нужно не больше сэмплов, чем было сгенерировано для нее, и только
+        в течение interpretation_cache_ttl секунд; остальные обращения считаются промахами.
+        """
+        use_cache = self.interpretation_cache.max_size > 0
+        min_time = time.time() - self.interpretation_cache_ttl
+
+        def accept(cached):
+            return cached[0] >= min_time and cached[1] >= num_return_sequences
+
+        outputs = [None] * len(contexts)
+        key2icontexts = dict()
+        for icontext, phrases in enumerate(contexts):
+            key = RuT5Interpreter.make_cache_key(phrases)
+            cached = self.interpretation_cache.get(key, accept=accept) if use_cache else None
+            if cached is not None:
+                samples = cached[2]
+                outputs[icontext] = random.sample(samples, min(num_return_sequences, len(samples)))
+            else:
+                key2icontexts.setdefault(key, []).append(icontext)
+
+        if key2icontexts:
+            if use_cache:
+                self.logger.debug('Interpretation cache@75: %d hits, %d misses, hit rate=%f',
+                                  self.interpretation_cache.hits, self.interpretation_cache.misses, self.interpretation_cache.get_hit_rate())
+
+            miss_keys = list(key2icontexts.keys())
+            miss_outputs = self.generate_batch([contexts[key2icontexts[key][0]] for key in miss_keys], num_return_sequences, tokens_cache)
+            t = time.time()
+            for key, samples in zip(miss_keys, miss_outputs):
+                self.interpretation_cache.put(key, (t, num_return_sequences, samples))
+                for icontext in key2icontexts[key]:
+                    outputs[icontext] = samples
+
+        return outputs
+
+    def generate_batch(self, contexts, num_return_sequences, tokens_cache=None):
+        """Прогон модели для списка контекстов, вернет для каждого контекста список уникальных вариантов."""
+        inputs_ids = [self.encode_input(phrases, tokens_cache) for phrases in contexts]
+        max_len = max(map(len, inputs_ids))
+        pad_token_id = self.tokenizer.pad_token_id
+        input_ids = torch.tensor([ids + [pad_token_id] * (max_len - len(ids)) for ids in inputs_ids], dtype=torch.long, device=self.device)
+        attention_mask = torch.tensor([[1] * len(ids) + [0] * (max_len - len(ids)) for ids in inputs_ids], dtype=torch.long, device=self.device)
+
         out_ids = self.model.generate(input_ids=input_ids,
+                                      attention_mask=attention_mask,
                                       max_length=60,
                                       eos_token_id=self.tokenizer.eos_token_id,
                                       do_sample=True,
@@ -40,13 +140,19 @@ class RuT5Interpreter(BaseUtteranceInterpreter2):
                                       num_return_sequences=num_return_sequences,
                                       )
 
-        outputs = set()
+        outputs = [[] for _ in contexts]
         for i in range(len(out_ids)):
             o = self.tokenizer.decode(out_ids[i][1:])
-            o = o[:o.index('</s>')]
-            outputs.add(o)
+            if '</s>' in o:
+                o = o[:o.index('</s>')]
+            else:
+                o = o.replace('<pad>', '').strip()
+
+            icontext = i // num_return_sequences
+            if o not in outputs[icontext]:
+                outputs[icontext].append(o)
 
-        return list(outputs)
+        return outputs
 
 
 if __name__ == '__main__':
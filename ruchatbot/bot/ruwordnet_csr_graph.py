@@ -0,0 +1,173 @@
+"""
+Компактное представление графа синонимов RuWordNet в формате CSR для RelevancyScorer.
+
+Смежность хранится в двух массивах: offsets (int64, n+1 элементов) и neighbors (int32, id соседних лемм),
+плюс таблица строк лемм. Все это пишется в один бинарный файл, который при загрузке отображается в память
+через numpy.memmap, поэтому загрузка быстрая, а страницы файла разделяются между процессами сервиса.
+
+Таблица лемм тоже остается в отображенном файле: леммы упорядочены по байтам utf-8, id леммы равен ее
+позиции, поэтому id по тексту леммы находится бинарным поиском. В памяти процесса хранятся только
+результаты уже выполненных поисков (LRU-кэш), а обход графа идет по целочисленным id.
+
+Формат файла (little-endian):
+    MAGIC (8 байт)
+    nb_lemmas, nb_neighbors, nb_lemma_bytes (uint64)
+    offsets[nb_lemmas+1] (int64)
+    neighbors[nb_neighbors] (int32)
+    lemma_offsets[nb_lemmas+1] (int64)
+    lemma_bytes[nb_lemma_bytes] (utf-8, леммы отсортированы по байтам)
+
+Конвертация из ruwordnet.pkl:
+    python -m ruchatbot.bot.ruwordnet_csr_graph models/ruwordnet.pkl models/ruwordnet.csr
+"""
+
+import pickle
+import struct
+import sys
+
+import numpy as np
+
+from ruchatbot.utils.lru_cache import LruCache
+
+
+def normalize_lemma(word):
+    return word.replace('ё', 'е').lower()
+
+
+class CsrGraph(object):
+    MAGIC = b'RWNCSR02'
+    OLD_MAGICS = (b'RWNCSR01',)
+    HEADER = struct.Struct('<8sQQQ')
+
+    def __init__(self, offsets, neighbors, lemma_offsets, lemma_data, lookup_cache_size=100000):
+        self.offsets = offsets
+        self.neighbors_ids = neighbors
+        self.lemma_offsets = lemma_offsets
+        self.lemma_data = lemma_data
+        self.nb_lemmas = len(lemma_offsets) - 1
+        self.lemma2id_cache = LruCache(max_size=lookup_cache_size)  # лемма => id или -1, если леммы нет в графе
+
+    @staticmethod
+    def from_wordnet(wordnet):
+        """Строим неориентированный граф из словаря слово => список связанных слов (содержимое ruwordnet.pkl)."""
+        edges = set()
+        for word1, words2 in wordnet.items():
+            for word2 in words2:
+                edges.add((normalize_lemma(word1), normalize_lemma(word2)))
+
+        lemma_set = set()
+        for lemma1, lemma2 in edges:
+            lemma_set.add(lemma1)
+            lemma_set.add(lemma2)
+        lemma_data = sorted(lemma.encode('utf-8') for lemma in lemma_set)
+        lemma2id = dict((b.decode('utf-8'), i) for i, b in enumerate(lemma_data))
+
+        adjacency = [set() for _ in lemma_data]
+        for lemma1, lemma2 in edges:
+            id1 = lemma2id[lemma1]
+            id2 = lemma2id[lemma2]
+            adjacency[id1].add(id2)
+            adjacency[id2].add(id1)
+
+        offsets = np.zeros(len(adjacency) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(a) for a in adjacency])
+        neighbors = np.fromiter((n for a in adjacency for n in sorted(a)), dtype=np.int32, count=int(offsets[-1]))
+        lemma_offsets = np.zeros(len(lemma_data) + 1, dtype=np.int64)
+        lemma_offsets[1:] = np.cumsum([len(b) for b in lemma_data])
+        return CsrGraph(offsets, neighbors, lemma_offsets, np.frombuffer(b''.join(lemma_data), dtype=np.uint8))
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(CsrGraph.HEADER.pack(CsrGraph.MAGIC, self.nb_lemmas, len(self.neighbors_ids), len(self.lemma_data)))
+            f.write(np.asarray(self.offsets, dtype='<i8').tobytes())
+            f.write(np.asarray(self.neighbors_ids, dtype='<i4').tobytes())
+            f.write(np.asarray(self.lemma_offsets, dtype='<i8').tobytes())
+            f.write(np.asarray(self.lemma_data, dtype=np.uint8).tobytes())
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            magic, nb_lemmas, nb_neighbors, nb_lemma_bytes = CsrGraph.HEADER.unpack(f.read(CsrGraph.HEADER.size))
+        if magic in CsrGraph.OLD_MAGICS:
+            raise RuntimeError('File "{}" has an old RuWordNet CSR format, rebuild it with "python -m ruchatbot.bot.ruwordnet_csr_graph"'.format(path))
+        if magic != CsrGraph.MAGIC:
+            raise RuntimeError('File "{}" is not a RuWordNet CSR graph'.format(path))
+
+        def map_array(dtype, offset, size):
+            if size == 0:
+                return np.zeros(0, dtype=dtype)
+            return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(size,))
+
+        pos = CsrGraph.HEADER.size
+        offsets = map_array('<i8', pos, nb_lemmas + 1)
+        pos += offsets.nbytes
+        neighbors = map_array('<i4', pos, nb_neighbors)
+        pos += neighbors.nbytes
+        lemma_offsets = map_array('<i8', pos, nb_lemmas + 1)
+        pos += lemma_offsets.nbytes
+        lemma_data = map_array(np.uint8, pos, nb_lemma_bytes)
+        return CsrGraph(offsets, neighbors, lemma_offsets, lemma_data)
+
+    def get_lemma_bytes(self, lemma_id):
+        return self.lemma_data[self.lemma_offsets[lemma_id]: self.lemma_offsets[lemma_id + 1]].tobytes()
+
+    def get_lemma(self, lemma_id):
+        return self.get_lemma_bytes(lemma_id).decode('utf-8')
+
+    def get_lemma_id(self, lemma):
+        """Вернет id леммы или None, если такой леммы в графе нет."""
+        lemma_id = self.lemma2id_cache.get(lemma)
+        if lemma_id is None:
+            key = lemma.encode('utf-8')
+            lo = 0
+            hi = self.nb_lemmas
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.get_lemma_bytes(mid) < key:
+                    lo = mid + 1
+                else:
+                    hi = mid
+
+            lemma_id = lo if lo < self.nb_lemmas and self.get_lemma_bytes(lo) == key else -1
+            self.lemma2id_cache.put(lemma, lemma_id)
+
+        return lemma_id if lemma_id >= 0 else None
+
+    def __contains__(self, lemma):
+        return self.get_lemma_id(lemma) is not None
+
+    def __len__(self):
+        return self.nb_lemmas
+
+    def neighbor_ids(self, lemma_id):
+        """Список id соседей леммы с указанным id."""
+        return self.neighbors_ids[self.offsets[lemma_id]: self.offsets[lemma_id + 1]].tolist()
+
+    def neighbors(self, lemma):
+        return [self.get_lemma(i) for i in self.neighbor_ids(self.get_lemma_id(lemma))]
+
+    def has_edge(self, lemma1, lemma2):
+        id1 = self.get_lemma_id(lemma1)
+        id2 = self.get_lemma_id(lemma2)
+        return id1 is not None and id2 is not None and id2 in self.neighbor_ids(id1)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('Usage: python -m ruchatbot.bot.ruwordnet_csr_graph <ruwordnet.pkl> <ruwordnet.csr>')
+        exit(1)
+
+    with open(sys.argv[1], 'rb') as f:
+        wordnet = pickle.load(f)
+
+    graph = CsrGraph.from_wordnet(wordnet)
+    graph.save(sys.argv[2])
+
+    # Проверяем, что сохраненный граф читается обратно без искажений.
+    graph2 = CsrGraph.load(sys.argv[2])
+    assert np.array_equal(graph2.lemma_offsets, graph.lemma_offsets) and np.array_equal(graph2.lemma_data, graph.lemma_data)
+    assert np.array_equal(graph2.offsets, graph.offsets) and np.array_equal(graph2.neighbors_ids, graph.neighbors_ids)
+    for word1, words2 in wordnet.items():
+        for word2 in words2:
+            assert graph2.has_edge(normalize_lemma(word1), normalize_lemma(word2))
+    print('{} lemmas, {} edges written to "{}"'.format(len(graph), len(graph.neighbors_ids) // 2, sys.argv[2]))
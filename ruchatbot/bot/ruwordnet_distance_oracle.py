@@ -0,0 +1,133 @@
+"""
+Поиск кратчайших путей ограниченной длины в графе RuWordNet для RelevancyScorer.
+
+Для лемм запроса делается обход в ширину на глубину не более max_depth, для каждой достигнутой
+вершины запоминается предшественник. Результаты обхода кэшируются по исходной лемме, поэтому
+пути от одной леммы запроса до лемм всех предпосылок восстанавливаются без повторных обходов.
+Пары, расстояние между которыми больше max_depth, считаются несвязанными: их вклад в оценку
+релевантности все равно ниже любых используемых порогов.
+
+Обход идет по целочисленным id лемм, строки переводятся в id один раз на входе и обратно только
+для найденного пути. Граф должен поддерживать get_lemma_id(lemma), get_lemma(lemma_id) и
+neighbor_ids(lemma_id), как CsrGraph.
+"""
+
+from ruchatbot.utils.lru_cache import LruCache
+
+
+class BoundedDistanceOracle(object):
+    def __init__(self, graph, max_depth=4, cache_size=200):
+        """
+        :param graph: граф лемм CsrGraph
+        :param max_depth: максимальное количество ребер в искомом пути
+        :param cache_size: для скольких исходных лемм хранить результаты обхода
+        """
+        self.graph = graph
+        self.max_depth = max_depth
+        self.bfs_cache = LruCache(max_size=cache_size)
+
+    def bfs(self, source_id):
+        """Обход в ширину из source_id на глубину max_depth, вернет словарь id вершины => id предшественника (-1 для source_id)."""
+        parents = self.bfs_cache.get(source_id)
+        if parents is None:
+            parents = {source_id: -1}
+            frontier = [source_id]
+            for depth in range(self.max_depth):
+                next_frontier = []
+                for node in frontier:
+                    for neighbor in self.graph.neighbor_ids(node):
+                        if neighbor not in parents:
+                            parents[neighbor] = node
+                            next_frontier.append(neighbor)
+                if not next_frontier:
+                    break
+                frontier = next_frontier
+
+            self.bfs_cache.put(source_id, parents)
+
+        return parents
+
+    def shortest_path_ids(self, source_id, target_id):
+        """Вернет кратчайший путь из id лемм [source_id, ..., target_id] длиной не более max_depth ребер или None."""
+        parents = self.bfs(source_id)
+        if target_id not in parents:
+            return None
+
+        path = [target_id]
+        node = parents[target_id]
+        while node != -1:
+            path.append(node)
+            node = parents[node]
+        path.reverse()
+        return path
+
+    def distance_ids(self, source_id, target_id):
+        """Количество ребер в кратчайшем пути между леммами с указанными id или None, если путь длиннее max_depth."""
+        if source_id == target_id:
+            return 0
+
+        parents = self.bfs(source_id)
+        if target_id not in parents:
+            return None
+
+        d = 0
+        node = target_id
+        while node != source_id:
+            node = parents[node]
+            d += 1
+        return d
+
+    def shortest_path(self, source, target):
+        """Вернет кратчайший путь [source, ..., target] длиной не более max_depth ребер или None."""
+        source_id = self.graph.get_lemma_id(source)
+        target_id = self.graph.get_lemma_id(target)
+        if source_id is None or target_id is None:
+            return None
+
+        path = self.shortest_path_ids(source_id, target_id)
+        if path is None:
+            return None
+        return [self.graph.get_lemma(node) for node in path]
+
+    def distance(self, source, target):
+        """Количество ребер в кратчайшем пути между леммами или None, если путь длиннее max_depth."""
+        if source == target:
+            return 0
+
+        source_id = self.graph.get_lemma_id(source)
+        target_id = self.graph.get_lemma_id(target)
+        if source_id is None or target_id is None:
+            return None
+
+        return self.distance_ids(source_id, target_id)
+
+    def clear(self):
+        self.bfs_cache.clear()
+
+
+if __name__ == '__main__':
+    # Сверка с networkx на случайном графе.
+    import random
+    import networkx as nx
+
+    from ruchatbot.bot.ruwordnet_csr_graph import CsrGraph
+
+    g = nx.gnm_random_graph(2000, 3000, seed=1)
+    g = nx.relabel_nodes(g, {i: 'слово{}'.format(i) for i in g.nodes})
+    g.remove_nodes_from([n for n in list(g.nodes) if g.degree(n) == 0])
+    oracle = BoundedDistanceOracle(CsrGraph.from_wordnet(dict((n, list(g.neighbors(n))) for n in g.nodes)), max_depth=4)
+    nodes = list(g.nodes)
+    for _ in range(5000):
+        n1, n2 = random.choice(nodes), random.choice(nodes)
+        p1 = oracle.shortest_path(n1, n2)
+        try:
+            p2 = nx.shortest_path(g, source=n1, target=n2)
+        except nx.exception.NetworkXNoPath:
+            p2 = None
+
+        if p2 is None or len(p2) - 1 > oracle.max_depth:
+            assert p1 is None, (n1, n2, p1, p2)
+        else:
+            assert p1 is not None and len(p1) == len(p2) and p1[0] == n1 and p1[-1] == n2, (n1, n2, p1, p2)
+            assert all(g.has_edge(a, b) for a, b in zip(p1, p1[1:]))
+    print('All checks passed, BFS cache hit rate={:.3f}'.format(oracle.bfs_cache.get_hit_rate()))
@@ -1,9 +1,32 @@
+"""
+Оценка семантической близости фраз по путям между леммами в графе RuWordNet.
+
+19.10.2026 Кратчайшие пути ищутся обходом в ширину ограниченной глубины с кэшированием по лемме запроса (BoundedDistanceOracle).
+19.10.2026 Леммы предпосылок извлекаются один раз и хранятся как массивы id интернированных лемм, при запросе парсится только вопрос.
+           Индекс предпосылок строится при загрузке бота для всех фактов профиля (index_premises) и пополняется
+           фактами, запомненными в ходе диалога; match1/match2 только читают его.
+19.10.2026 В match2 кандидаты для второй предпосылки берутся из инвертированного индекса лемма => предпосылки с учетом
+           соседей в графе, кэш оценок пар предпосылок ограничен по размеру и может сохраняться на диск.
+19.10.2026 Новые предпосылки парсятся одним пакетом (UdpipeParser.parse_batch).
+19.10.2026 Леммы фраз берутся из общего для компонентов бота AnalyzedText (TextUtils.analyze), так что
+           реплика лемматизируется один раз.
+19.10.2026 Граф RuWordNet хранится в формате CSR (CsrGraph) и загружается из ruwordnet.csr через memmap, networkx не нужен.
+19.10.2026 Леммы динамических фактов (текущее время и т.д.) хранятся по одной записи на факт и пересчитываются
+           только при смене ревизии факта в DynamicFactsCache, поэтому ежеминутно меняющийся "Сейчас N часов M минут"
+           не вытесняет другие предпосылки из LRU-кэша.
+"""
+
+from array import array
 import os
 import pickle
 import math
 import io
+import threading
 
-import networkx as nx
+from ruchatbot.bot.ruwordnet_csr_graph import CsrGraph
+from ruchatbot.bot.ruwordnet_distance_oracle import BoundedDistanceOracle
+from ruchatbot.bot.simple_facts_storage import dynamic_facts_cache
+from ruchatbot.utils.lru_cache import LruCache
 
 
 class RelevancyScore(object):
@@ -19,47 +42,143 @@ class RelevancyScore(object):
 
 
 class RelevancyScorer(object):
-    def __init__(self, parser):
-        self.parser = parser
-        self.score12_cache = dict()
+    def __init__(self, text_utils):
+        self.text_utils = text_utils
+        self.score12_cache = LruCache(max_size=100000)  # (предпосылка1, предпосылка2) => RelevancyScore
+        self.score12_cache_path = None  # если задан, кэш оценок пар загружается из этого файла и сохраняется в него
+        self.max_path_depth = 4  # пути длиннее дают оценку ниже exp(-2), такие пары считаем несвязанными
+        self.oracle = None
+        self.lemma2id = dict()
+        self.lemmas = []
+        self.lemmas_lock = threading.Lock()  # скорер общий для всех сессий, интернирование лемм идет из разных потоков
+        self.premise2lemma_ids = dict()  # индекс: текст факта профиля или запомненного факта => array('I') с id его лемм
+        self.other_premise2lemma_ids = LruCache(max_size=10000)  # то же для прочих фактов вне индекса
+        self.dynamic_facts = dynamic_facts_cache
+        self.dynamic_fact_lemma_ids = dict()  # id динамического факта => (ревизия, текст факта, array('I') с id лемм)
+        self.parse_workers = 0  # если больше 1, большие наборы новых фактов парсятся в пуле процессов
 
     def load(self, model_dir):
-        with open(os.path.join(model_dir, 'ruwordnet.pkl'), 'rb') as f:
-            wordnet = pickle.load(f)
+        csr_path = os.path.join(model_dir, 'ruwordnet.csr')
+        if os.path.exists(csr_path):
+            self.TG = CsrGraph.load(csr_path)
+        else:
+            # Сконвертированного графа нет, строим его из исходного словаря (см. __main__ в ruwordnet_csr_graph.py)
+            with open(os.path.join(model_dir, 'ruwordnet.pkl'), 'rb') as f:
+                wordnet = pickle.load(f)
+            self.TG = CsrGraph.from_wordnet(wordnet)
+
+        self.oracle = BoundedDistanceOracle(self.TG, max_depth=self.max_path_depth)
+
+        if self.score12_cache_path is not None and os.path.exists(self.score12_cache_path):
+            self.load_score12_cache(self.score12_cache_path)
 
-        self.TG = nx.Graph()
-        for word1, words2 in wordnet.items():
-            for word2 in words2:
-                self.TG.add_edge(word1.replace('ё', 'е').lower(), word2.replace('ё', 'е').lower())
+    def load_score12_cache(self, cache_path):
+        with open(cache_path, 'rb') as f:
+            for key, score12 in pickle.load(f):
+                self.score12_cache.put(key, score12)
+
+    def save_score12_cache(self, cache_path=None):
+        if cache_path is None:
+            cache_path = self.score12_cache_path
+        # Пишем во временный файл, чтобы прерванное сохранение не испортило кэш с прошлого запуска.
+        tmp_path = cache_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self.score12_cache.items(), f)
+        os.replace(tmp_path, cache_path)
 
     def extract_lemmas(self, text):
-        lemmas = set()
-        for parsing in self.parser.parse_text(text):
-            for t in parsing:
-                if t.upos in ('VERB', 'ADJ', 'ADV', 'NOUN', 'PROPN'):
-                    lemmas.add(t.lemma)
-        return lemmas
+        return self.text_utils.analyze(text).get_lemma_set()
+
+    def intern_lemma(self, lemma):
+        lemma_id = self.lemma2id.get(lemma)
+        if lemma_id is None:
+            with self.lemmas_lock:
+                lemma_id = self.lemma2id.get(lemma)
+                if lemma_id is None:
+                    lemma_id = len(self.lemmas)
+                    self.lemmas.append(lemma)
+                    self.lemma2id[lemma] = lemma_id
+        return lemma_id
+
+    def extract_lemma_ids(self, text):
+        return array('I', sorted(self.intern_lemma(lemma) for lemma in self.extract_lemmas(text)))
+
+    def extract_lemma_ids_batch(self, premises):
+        # результаты пакетного парсинга попадут в кэш парсера и будут использованы в extract_lemmas
+        if self.parse_workers > 1 and len(premises) >= self.parse_workers * 50:
+            self.text_utils.parser.parse_many(premises, workers=self.parse_workers, need_syntax=False)
+        elif len(premises) > 1:
+            self.text_utils.parser.parse_batch(premises, need_syntax=False)
+        return [self.extract_lemma_ids(premise) for premise in premises]
+
+    def index_premises(self, premises):
+        """
+        Добавляем в индекс леммы предпосылок, которых в нем еще нет. Вызывается один раз при загрузке бота
+        для всех фактов профиля и для каждого нового факта, запомненного в ходе диалога.
+        Вернет количество добавленных предпосылок.
+        """
+        new_premises = list(dict.fromkeys(premise for premise in premises if premise not in self.premise2lemma_ids))
+        for premise, lemma_ids in zip(new_premises, self.extract_lemma_ids_batch(new_premises)):
+            self.premise2lemma_ids[premise] = lemma_ids
+        return len(new_premises)
+
+    def lookup_facts(self, facts):
+        """
+        Вернет словарь текст предпосылки => массив id ее лемм (общий с индексом, не модифицировать) для фактов facts.
+        Леммы берутся из индекса. Для динамических фактов (текущее время и т.д.) леммы хранятся по id факта
+        и пересчитываются при смене его ревизии. Для остальных фактов вне индекса (временные факты
+        при проверке ответа) леммы извлекаются здесь и хранятся в отдельном LRU-кэше.
+        """
+        premise2lemma_ids = dict()
+        missing_premises = []
+        missing_dynamic_facts = dict()  # текст факта => (id факта, ревизия)
+        for premise, _, fact_tag in facts:
+            if premise not in premise2lemma_ids:
+                lemma_ids = self.premise2lemma_ids.get(premise)
+                if lemma_ids is None:
+                    fact_id = self.dynamic_facts.get_fact_id(fact_tag)
+                    if fact_id is not None:
+                        revision = self.dynamic_facts.get_revision(fact_tag)
+                        cached = self.dynamic_fact_lemma_ids.get(fact_id)
+                        # Текст сверяем на случай, если список фактов получен до смены ревизии.
+                        if cached is not None and cached[0] == revision and cached[1] == premise:
+                            lemma_ids = cached[2]
+                        else:
+                            missing_dynamic_facts[premise] = (fact_id, revision)
+                    else:
+                        lemma_ids = self.other_premise2lemma_ids.get(premise)
+                    if lemma_ids is None:
+                        missing_premises.append(premise)
+                premise2lemma_ids[premise] = lemma_ids
+
+        for premise, lemma_ids in zip(missing_premises, self.extract_lemma_ids_batch(missing_premises)):
+            if premise in missing_dynamic_facts:
+                fact_id, revision = missing_dynamic_facts[premise]
+                self.dynamic_fact_lemma_ids[fact_id] = (revision, premise, lemma_ids)
+            else:
+                self.other_premise2lemma_ids.put(premise, lemma_ids)
+            premise2lemma_ids[premise] = lemma_ids
+
+        return premise2lemma_ids
 
     def score_relevancy(self, premise, query):
-        p_lemmas = self.extract_lemmas(premise)
-        q_lemmas = self.extract_lemmas(query)
-        return self._score(p_lemmas, q_lemmas)
+        p_lemma_ids = self.extract_lemma_ids(premise)
+        q_lemma_ids = self.extract_lemma_ids(query)
+        return self._score(p_lemma_ids, q_lemma_ids)
 
-    def _score(self, p_lemmas, q_lemmas):
+    def _score(self, p_lemma_ids, q_lemma_ids):
+        lemmas = self.lemmas
         min_path = None
-        for q_lemma in q_lemmas:
-            for p_lemma in p_lemmas:
-                if q_lemma == p_lemma:
-                    min_path = [q_lemma]
+        for q_lemma_id in q_lemma_ids:
+            for p_lemma_id in p_lemma_ids:
+                if q_lemma_id == p_lemma_id:
+                    min_path = [lemmas[q_lemma_id]]
                     break
 
-                if p_lemma in self.TG and q_lemma in self.TG:
-                    try:
-                        p = nx.shortest_path(self.TG, source=q_lemma, target=p_lemma)
-                        if min_path is None or len(p) < len(min_path):
-                            min_path = p
-                    except nx.exception.NetworkXNoPath as ex:
-                        pass
+                p = self.oracle.shortest_path(lemmas[q_lemma_id], lemmas[p_lemma_id])
+                if p is not None:
+                    if min_path is None or len(p) < len(min_path):
+                        min_path = p
 
         if min_path is None:
             return RelevancyScore([], 0.0)
@@ -68,10 +187,9 @@ class RelevancyScorer(object):
 
     def match1(self, query, facts, threshold=0.3):
         matches = []
-        q_lemmas = self.extract_lemmas(query)
-        for premise, _, _ in facts:
-            p_lemmas = self.extract_lemmas(premise)
-            score = self._score(p_lemmas, q_lemmas)
+        q_lemma_ids = self.extract_lemma_ids(query)
+        for premise, p_lemma_ids in self.lookup_facts(facts).items():
+            score = self._score(p_lemma_ids, q_lemma_ids)
             if score.score >= threshold:
                 matches.append((premise, score))
 
@@ -82,20 +200,42 @@ class RelevancyScorer(object):
         matches1 = []
         premise2score = dict()
 
-        q_lemmas = self.extract_lemmas(query)
-        for premise, _, _ in facts:
-            p_lemmas = self.extract_lemmas(premise)
-            score = self._score(p_lemmas, q_lemmas)
+        q_lemma_ids = self.extract_lemma_ids(query)
+        premise2lemmas = self.lookup_facts(facts)
+        for premise, p_lemma_ids in premise2lemmas.items():
+            score = self._score(p_lemma_ids, q_lemma_ids)
             if score.score >= threshold:
                 matches1.append((premise, score))
                 premise2score[premise] = score
 
         matches1 = sorted(matches1, key=lambda z: -z[1].score)
+
+        # Инвертированный индекс лемма => предпосылки, сопоставленные с вопросом (только они могут стать premise2).
+        premise2index = dict((premise, i) for i, premise in enumerate(premise2lemmas.keys()))
+        lemma2premises = dict()
+        for premise in premise2score.keys():
+            for lemma_id in premise2lemmas[premise]:
+                lemma2premises.setdefault(lemma_id, []).append(premise)
+
+        # Оценка пары предпосылок не ниже threshold возможна только для лемм на расстоянии не больше max_radius ребер.
+        # Радиус подбираем той же формулой, что и в _score, без вычисления логарифма и округления.
+        max_radius = 0
+        while max_radius < self.max_path_depth and math.exp(-(max_radius + 1) * 0.5) >= threshold:
+            max_radius += 1
+
         matches2 = []
         matched_pairs = set()
         for premise1, score1 in matches1[:10]:
-            for premise2, _, _ in facts:
-                if premise1 != premise2 and premise2 in premise2score:
+            candidates = set()
+            for lemma_id, premises in lemma2premises.items():
+                for lemma1_id in premise2lemmas[premise1]:
+                    d = self.oracle.distance(self.lemmas[lemma1_id], self.lemmas[lemma_id])
+                    if d is not None and d <= max_radius:
+                        candidates.update(premises)
+                        break
+
+            for premise2 in sorted(candidates, key=lambda premise: premise2index[premise]):
+                if premise1 != premise2:
                     # НАЧАЛО ОТЛАДКИ
                     #if premise1 == 'Сократ - философ' and premise2 == 'все философы смертны':
                     #    print('DEBUG@101')
@@ -106,8 +246,8 @@ class RelevancyScorer(object):
                         if (premise1, premise2) not in matched_pairs and (premise2, premise1) not in matched_pairs:
                             score12 = self.score12_cache.get((premise1, premise2))
                             if score12 is None:
-                                score12 = self.score_relevancy(premise1, premise2)  # premise1 <==> premise2
-                                self.score12_cache[(premise1, premise2)] = score12
+                                score12 = self._score(premise2lemmas[premise1], premise2lemmas[premise2])  # premise1 <==> premise2
+                                self.score12_cache.put((premise1, premise2), score12)
 
                             if score12.score >= threshold:
                                 score12_endlemmas = score12.endlemmas()
@@ -38,3 +38,32 @@ class SbertRelevancyDetector(object):
         closest_premises = sorted(closest_premises, key=lambda z: -z[1])
 
         return [x[0] for x in closest_premises], [x[1] for x in closest_premises]
+
+    def get_most_relevant_batch(self, queries, premises, nb_results=1):
+        """
+        То же, что get_most_relevant, но сразу для нескольких запросов: эмбеддинги фактов вычисляются один раз.
+        Вернет список пар (список фактов, список релевантностей) для каждого запроса.
+        """
+        results = [None] * len(queries)
+        model_queries = []
+        for iquery, query in enumerate(queries):
+            uquery = normalize_for_lookup(query)
+            for premise in premises:
+                if uquery == normalize_for_lookup(premise[0]):
+                    results[iquery] = ([premise[0]], [1.0])
+                    break
+            else:
+                model_queries.append(iquery)
+
+        if model_queries:
+            embeddings = self.model.encode([p[0] for p in premises] + [queries[i] for i in model_queries], convert_to_tensor=True, device=self.device)
+            qx_v = embeddings[len(premises):]
+            px_v = embeddings[:len(premises)]
+            rx = sentence_transformers.util.semantic_search(query_embeddings=qx_v, corpus_embeddings=px_v,
+                                                            query_chunk_size=100, corpus_chunk_size=100, top_k=nb_results)
+            for iquery, hits in zip(model_queries, rx):
+                closest_premises = [(premises[x['corpus_id']][0], x['score']) for x in hits if x['score'] >= 0.70]
+                closest_premises = sorted(closest_premises, key=lambda z: -z[1])
+                results[iquery] = ([x[0] for x in closest_premises], [x[1] for x in closest_premises])
+
+        return results
@@ -0,0 +1,108 @@
+"""
+Хранилище KV-кэшей gpt-модели читчата для диалоговых сессий.
+
+Контекст читчата от хода к ходу растет на одну-две реплики, поэтому для каждой сессии
+храним past_key_values для последнего уже обработанного префикса промпта. При следующей
+генерации используем общий префикс старого и нового промпта и прогоняем через модель только
+добавившиеся токены. Если окно истории сдвинулось и начало промпта изменилось, общий префикс
+становится коротким (или пустым), и кэш фактически пересчитывается заново.
+
+Суммарный объем кэшей ограничен количеством токенов, сессии вытесняются по принципу LRU.
+"""
+
+import collections
+import threading
+
+try:
+    from transformers import DynamicCache
+except ImportError:
+    DynamicCache = None
+
+
+def to_legacy_past(past_key_values):
+    """Приводим KV-кэш к кортежу тензоров, который можно безопасно хранить и переиспользовать."""
+    if hasattr(past_key_values, 'to_legacy_cache'):
+        return past_key_values.to_legacy_cache()
+    if hasattr(past_key_values, 'layers'):
+        # В новых версиях transformers у DynamicCache нет to_legacy_cache.
+        return tuple((layer.keys, layer.values) for layer in past_key_values.layers)
+    return past_key_values
+
+
+def to_model_past(legacy_past):
+    """Новый объект кэша для прогона модели; сохраненные тензоры при этом не модифицируются."""
+    if legacy_past is None:
+        return None
+    if DynamicCache is not None:
+        if hasattr(DynamicCache, 'from_legacy_cache'):
+            return DynamicCache.from_legacy_cache(legacy_past)
+        return DynamicCache(legacy_past)
+    return legacy_past
+
+
+def crop_legacy_past(legacy_past, length):
+    return tuple((k[:, :, :length, :], v[:, :, :length, :]) for k, v in legacy_past)
+
+
+class SessionKVCache(object):
+    def __init__(self, max_tokens=100000):
+        """
+        :param max_tokens: суммарное количество токенов в кэшах всех сессий
+        """
+        self.max_tokens = max_tokens
+        self.session2entry = collections.OrderedDict()  # session_id => (кортеж id токенов, past_key_values)
+        self.total_tokens = 0
+        self.lock = threading.Lock()
+
+    def lookup(self, session_id, token_ids):
+        """
+        Вернет пару (количество токенов общего префикса, past_key_values для этого префикса).
+        Если для сессии ничего подходящего нет, вернет (0, None).
+        """
+        with self.lock:
+            entry = self.session2entry.get(session_id)
+            if entry is None:
+                return 0, None
+
+            self.session2entry.move_to_end(session_id)
+            cached_ids, legacy_past = entry
+
+            common_len = 0
+            for cached_id, token_id in zip(cached_ids, token_ids):
+                if cached_id != token_id:
+                    break
+                common_len += 1
+
+            if common_len == 0:
+                return 0, None
+            elif common_len < len(cached_ids):
+                return common_len, crop_legacy_past(legacy_past, common_len)
+            else:
+                return common_len, legacy_past
+
+    def store(self, session_id, token_ids, past_key_values):
+        token_ids = tuple(token_ids)
+        if len(token_ids) > self.max_tokens:
+            self.invalidate(session_id)
+            return
+
+        with self.lock:
+            prev_entry = self.session2entry.pop(session_id, None)
+            if prev_entry is not None:
+                self.total_tokens -= len(prev_entry[0])
+
+            self.session2entry[session_id] = (token_ids, to_legacy_past(past_key_values))
+            self.total_tokens += len(token_ids)
+
+            while self.total_tokens > self.max_tokens:
+                _, (evicted_ids, _) = self.session2entry.popitem(last=False)
+                self.total_tokens -= len(evicted_ids)
+
+    def invalidate(self, session_id):
+        with self.lock:
+            entry = self.session2entry.pop(session_id, None)
+            if entry is not None:
+                self.total_tokens -= len(entry[0])
+
+    def __len__(self):
+        return len(self.session2entry)
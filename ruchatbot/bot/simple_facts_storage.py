@@ -3,6 +3,9 @@
 29.06.2020 Добавлены динамические факты "current_day_month" со строкой типа "сегодня 29 июня" и
            "current_year" со строкой типа "сейчас 2020 год"
 03.03.2022 Добавлены динамические факты "сейчас утро|день|вечер|ночь"
+19.10.2026 Динамические факты вычисляются в общем для всех собеседников кэше DynamicFactsCache, каждый факт
+           пересчитывается только при смене своего временного интервала (минута, час, день, месяц). У каждого
+           факта есть постоянный id и счетчик ревизий, увеличивающийся при изменении текста факта.
 """
 
 
@@ -10,6 +13,172 @@ from ruchatbot.bot.base_facts_storage import BaseFactsStorage
 
 import datetime
 import itertools
+import threading
+
+
+DWOS = 'понедельник вторник среда четверг пятница суббота воскресенье'.split()
+
+SEASONS = {12: u'зима', 1: u'зима', 2: u'зима',
+           3: u'весна', 4: u'весна', 5: u'весна',
+           6: u'лето', 7: u'лето', 8: u'лето',
+           9: u'осень', 10: u'осень', 11: u'осень'}
+
+MONTHS = {1: u'январь', 2: u'февраль', 3: u'март',
+          4: u'апрель', 5: u'май', 6: u'июнь', 7: u'июль',
+          8: u'август', 9: u'сентябрь', 10: u'октябрь', 11: u'ноябрь', 12: u'декабрь'}
+
+MONTHS_GEN = {1: 'января',  2: 'февраля', 3: 'марта',
+              4: 'апреля',  5: 'мая',     6: 'июня', 7: 'июля',
+              8: 'августа', 9: 'сентября', 10: 'октября', 11: 'ноября', 12: 'декабря'}
+
+
+def day_bucket(now):
+    return now.date()
+
+
+def month_bucket(now):
+    return now.year, now.month
+
+
+def hour_bucket(now):
+    return now.date(), now.hour
+
+
+def minute_bucket(now):
+    return now.date(), now.hour, now.minute
+
+
+def make_day_of_week(now):
+    return 'сегодня ' + DWOS[now.weekday()]
+
+
+def make_yesterday_day_of_week(now):
+    yesterday = now - datetime.timedelta(days=1)
+    s = DWOS[yesterday.weekday()]
+    if s[-1] in 'кг':
+        return 'вчера был ' + s
+    elif s[-1] == 'е':
+        return 'вчера было ' + s
+    else:
+        return 'вчера была ' + s
+
+
+def make_tomorrow_day_of_week(now):
+    tomorrow = now + datetime.timedelta(days=1)
+    return 'завтра будет ' + DWOS[tomorrow.weekday()]
+
+
+def make_season(now):
+    return u'сейчас ' + SEASONS[now.month]
+
+
+def make_times_of_day(now):
+    # 03.03.2022 Часть суток
+    current_hour = now.hour
+    if current_hour >= 23 or current_hour < 6:
+        return 'сейчас ночь.'
+    elif current_hour in [6, 7, 8, 9]:
+        return 'сейчас утро.'
+    elif current_hour in [10, 11, 12, 13, 14, 15, 16, 17, 18]:
+        return 'сейчас день.'
+    else:
+        return 'сейчас вечер.'
+
+
+def make_month(now):
+    return u'сейчас ' + MONTHS[now.month]
+
+
+def make_time(now):
+    # Текущее время с точностью до минуты
+    current_minute = now.minute
+    current_hour = now.hour
+    current_time = u'Сейчас ' + str(current_hour)
+    if 20 >= current_hour >= 5:
+        current_time += u' часов '
+    elif current_hour in [1, 21]:
+        current_time += u' час '
+    elif (current_hour % 10) in [2, 3, 4]:
+        current_time += u' часа '
+    else:
+        current_time += u' часов '
+
+    current_time += str(current_minute)
+    if current_minute > 11 and (current_minute % 10) == 1:
+        current_time += u' минута '
+    elif current_minute > 4 and (current_minute % 10) in [2, 3, 4]:
+        current_time += u' минуты '
+    else:
+        current_time += ' минут '
+    return current_time
+
+
+def make_day_month(now):
+    # Текущая дата в формате "29 июня"
+    return 'сегодня {} {}'.format(now.day, MONTHS_GEN[now.month])
+
+
+def make_year(now):
+    return 'сейчас идет {} год'.format(now.year)
+
+
+class DynamicFactsCache(object):
+    """
+    Общий для всех собеседников кэш фактов о текущем времени.
+    Id факта - его позиция в списке DYNAMIC_FACTS, этот порядок менять нельзя, новые факты добавляются в конец.
+    Ревизия факта увеличивается только тогда, когда при смене интервала изменился текст факта, поэтому
+    кэши эмбеддингов, лемм и т.д. могут использовать пару (id факта, ревизия) в качестве ключа
+    (см. RelevancyScorer.lookup_facts).
+    """
+
+    # (тэг факта, функция интервала, функция построения текста факта)
+    DYNAMIC_FACTS = [('current_day_of_week', day_bucket, make_day_of_week),
+                     ('yesterday_day_of_week', day_bucket, make_yesterday_day_of_week),
+                     ('tomorrow_day_of_week', day_bucket, make_tomorrow_day_of_week),
+                     ('current_season', month_bucket, make_season),
+                     ('current_times_of_day', hour_bucket, make_times_of_day),
+                     ('current_month', month_bucket, make_month),
+                     ('current_time', minute_bucket, make_time),
+                     ('current_day_month', day_bucket, make_day_month),
+                     ('current_year', month_bucket, make_year),
+                     ]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tag2id = dict((tag, fact_id) for fact_id, (tag, _, _) in enumerate(self.DYNAMIC_FACTS))
+        self.buckets = [None] * len(self.DYNAMIC_FACTS)
+        self.facts = [None] * len(self.DYNAMIC_FACTS)
+        self.revisions = [0] * len(self.DYNAMIC_FACTS)
+
+    def get_facts(self, now=None):
+        """Вернет список кортежей (текст_факта, '3', тэг_факта) для момента времени now"""
+        if now is None:
+            now = datetime.datetime.now()
+
+        with self.lock:
+            for fact_id, (tag, bucket_func, fact_func) in enumerate(self.DYNAMIC_FACTS):
+                bucket = bucket_func(now)
+                if bucket != self.buckets[fact_id]:
+                    self.buckets[fact_id] = bucket
+                    fact_text = fact_func(now)
+                    fact = self.facts[fact_id]
+                    if fact is None or fact[0] != fact_text:
+                        self.facts[fact_id] = (fact_text, '3', tag)
+                        self.revisions[fact_id] += 1
+
+            return list(self.facts)
+
+    def get_fact_id(self, fact_tag):
+        """Постоянный id динамического факта с указанным тэгом или None, если такого факта нет"""
+        return self.tag2id.get(fact_tag)
+
+    def get_revision(self, fact_tag):
+        """Текущая ревизия динамического факта с указанным тэгом или None, если такого факта нет"""
+        fact_id = self.tag2id.get(fact_tag)
+        return None if fact_id is None else self.revisions[fact_id]
+
+
+dynamic_facts_cache = DynamicFactsCache()
 
 
 class SimpleFactsStorage(BaseFactsStorage):
@@ -21,98 +190,14 @@ class SimpleFactsStorage(BaseFactsStorage):
 
     def __init__(self):
         super(SimpleFactsStorage, self).__init__()
+        self.dynamic_facts = dynamic_facts_cache
 
     def reset_added_facts(self):
         pass
 
     def enumerate_facts(self, interlocutor):
-        memory_phrases = []
-
-        # Добавляем динамические факты
-        # ==== День недели ====
-        dwos = 'понедельник вторник среда четверг пятница суббота воскресенье'.split()
-        today = datetime.datetime.today()
-        s = dwos[today.weekday()]
-        memory_phrases.append(('сегодня ' + s, '3', 'current_day_of_week'))
-
-        yesterday = today - datetime.timedelta(days=1)
-        s = dwos[yesterday.weekday()]
-        if s[-1] in 'кг':
-            memory_phrases.append(('вчера был ' + s, '3', 'yesterday_day_of_week'))
-        elif s[-1] == 'е':
-            memory_phrases.append(('вчера было ' + s, '3', 'yesterday_day_of_week'))
-        else:
-            memory_phrases.append(('вчера была ' + s, '3', 'yesterday_day_of_week'))
-
-        tomorrow = today + datetime.timedelta(days=1)
-        s = dwos[tomorrow.weekday()]
-        memory_phrases.append(('завтра будет ' + s, '3', 'tomorrow_day_of_week'))
-
-
-        # === Время года ===
-        cur_month = datetime.datetime.now().month
-        season = {12: u'зима', 1: u'зима', 2: u'зима',
-                  3: u'весна', 4: u'весна', 5: u'весна',
-                  6: u'лето', 7: u'лето', 8: u'лето',
-                  9: u'осень', 10: u'осень', 11: u'осень'}[cur_month]
-        memory_phrases.append((u'сейчас ' + season, '3', 'current_season'))
-
-        # 03.03.2022 Часть суток
-        current_hour = datetime.datetime.now().hour
-        if current_hour >= 23 or current_hour < 6:
-            tod_fact = 'сейчас ночь.'
-        elif current_hour in [6, 7, 8, 9]:
-            tod_fact = 'сейчас утро.'
-        elif current_hour in [10, 11, 12, 13, 14, 15, 16, 17, 18]:
-            tod_fact = 'сейчас день.'
-        else:
-            tod_fact = 'сейчас вечер.'
-        memory_phrases.append((tod_fact, '3', 'current_times_of_day'))
-
-        # === Текущий месяц ===
-        month = {1: u'январь', 2: u'февраль', 3: u'март',
-                 4: u'апрель', 5: u'май', 6: u'июнь', 7: u'июль',
-                 8: u'август', 9: u'сентябрь', 10: u'октябрь', 11: u'ноябрь', 12: u'декабрь'}[cur_month]
-        memory_phrases.append((u'сейчас ' + month, '3', 'current_month'))
-
-        # Добавляем текущее время с точностью до минуты
-        current_minute = datetime.datetime.now().minute
-        current_hour = datetime.datetime.now().hour
-        current_time = u'Сейчас ' + str(current_hour)
-        if 20 >= current_hour >= 5:
-            current_time += u' часов '
-        elif current_hour in [1, 21]:
-            current_time += u' час '
-        elif (current_hour % 10) in [2, 3, 4]:
-            current_time += u' часа '
-        else:
-            current_time += u' часов '
-
-        current_time += str(current_minute)
-        if current_minute > 11 and (current_minute % 10) == 1:
-            current_time += u' минута '
-        elif current_minute > 4 and (current_minute % 10) in [2, 3, 4]:
-            current_time += u' минуты '
-        else:
-            current_time += ' минут '
-
-        memory_phrases.append((current_time, '3', 'current_time'))
-
-        # Текущая дата в формате "29 июня"
-        cur_day = datetime.datetime.now().day
-        month_gen = {1: 'января',  2: 'февраля', 3: 'марта',
-                     4: 'апреля',  5: 'мая',     6: 'июня', 7: 'июля',
-                     8: 'августа', 9: 'сентября', 10: 'октября', 11: 'ноября', 12: 'декабря'}[cur_month]
-        memory_phrases.append(('сегодня {} {}'.format(cur_day, month_gen), '3', 'current_day_month'))
-
-        # Текущий год
-        memory_phrases.append(('сейчас идет {} год'.format(today.year), '3', 'current_year'))
-
-        # возвращаем список фактов (потом надо переделать на выдачу по мере чтения из файла и
-        # генерации через yield).
-        #for f in memory_phrases:
-        #    yield f
-        return memory_phrases
+        # Добавляем динамические факты, они общие для всех собеседников.
+        return self.dynamic_facts.get_facts()
 
     def store_new_fact(self, interlocutor, fact, unique):
         raise NotImplementedError()
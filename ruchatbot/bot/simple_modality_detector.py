@@ -21,7 +21,8 @@ class SimpleModalityDetectorRU(ModalityDetector):
 
         person = -1
 
-        words = text_utils.tokenize(phrase)
+        analysis = text_utils.analyze(phrase)
+        words = list(analysis.get_tokens())
 
         if person == -1:
             person = text_utils.detect_person0(words)
@@ -46,7 +47,7 @@ class SimpleModalityDetectorRU(ModalityDetector):
 
         # Определение императивных форм глаголов требует проведения частеречной
         # разметки, чтобы снять неоднозначности типа МОЙ/МЫТЬ
-        tags = list(text_utils.tag(words))
+        tags = analysis.get_tags()
 
         if phrase[-1] == '!':
             # Если есть глагол, то считаем императивом
@@ -13,45 +13,140 @@ NLP Pipeline чатбота
 05.05.2021 Грузим список имен, чтобы фильтровать результаты генерации читчата
 25.04.2022 Большой рефакторинг и чистка кода в связи с переходом на новую архитектуру
 13.11.2022 Используем обертку UdpipeParser
+19.10.2026 Результаты анализа реплик (токены, клаузы, теги, разбор) кэшируются в объектах AnalyzedText, см. analyze()
+19.10.2026 Словари, теггеры и парсер загружаются лениво при первом обращении, для полной загрузки заранее - warmup()
+19.10.2026 Пиковый RSS в логе warmup() берется через модуль resource, которого нет под Windows, см. get_peak_rss_mb()
 """
 
 import re
 import os
 import logging
 import pickle
+import sys
+import threading
+import time
 
-from ruchatbot.utils.udpipe_parser import UdpipeParser
+from ruchatbot.utils.lru_cache import LruCache
+from ruchatbot.bot.language_resources import LanguageResources
+from ruchatbot.bot.analyzed_text import AnalyzedText
 
-import rutokenizer
-import rupostagger
-import ruword2tags
 
-from ruchatbot.utils.tokenizer import Tokenizer
-from ruchatbot.bot.language_resources import LanguageResources
+def get_peak_rss_mb():
+    """ Пиковый RSS процесса в мегабайтах или None, если платформа не дает его узнать (Windows). """
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss под macOS в байтах, под Linux - в килобайтах
+    if sys.platform == 'darwin':
+        return maxrss / (1024.0 * 1024.0)
+    return maxrss / 1024.0
 
 
 class TextUtils(object):
+    # Ресурсы, загружаемые лениво при первом обращении к одноименному свойству
+    RESOURCES = ['clause_splitter', 'tokenizer', 'postagger', 'word2tags', 'parser', 'names']
+
     def __init__(self):
-        self.clause_splitter = rutokenizer.Segmenter()
-        self.tokenizer = Tokenizer()
-        self.tokenizer.load()
         self.language_resources = LanguageResources()
-        self.postagger = rupostagger.RuPosTagger()
-        self.word2tags = ruword2tags.RuWord2Tags()
-        self.names = None
-        self.parser = None
+        self.models_folder = None
+        self.resources = dict()
+        self.resources_lock = threading.RLock()
+        self.analysis_cache = LruCache(max_size=5000)
 
     def load_dictionaries(self, data_folder, models_folder):
-        self.postagger.load()
+        """
+        Запоминаем, откуда грузить модели. Сами ресурсы загружаются при первом обращении к ним,
+        так что утилитам, которым нужна только часть ресурсов, не приходится ждать загрузки остального.
+        """
+        self.models_folder = models_folder
+
+    def warmup(self):
+        """ Загрузка всех ресурсов заранее, чтобы первая реплика в продакшене не ждала загрузки. """
+        t0 = time.time()
+        for name in TextUtils.RESOURCES:
+            getattr(self, name)
+        maxrss = get_peak_rss_mb()
+        if maxrss is None:
+            logging.info('TextUtils warmup completed in %.1f sec', time.time() - t0)
+        else:
+            logging.info('TextUtils warmup completed in %.1f sec, peak RSS=%.0f Mb', time.time() - t0, maxrss)
+
+    def get_resource(self, name, load_fn):
+        res = self.resources.get(name)
+        if res is None:
+            with self.resources_lock:
+                res = self.resources.get(name)
+                if res is None:
+                    t0 = time.time()
+                    res = load_fn()
+                    self.resources[name] = res
+                    logging.debug('TextUtils: "%s" loaded in %.2f sec', name, time.time() - t0)
+        return res
+
+    def get_models_path(self, filename):
+        if self.models_folder is None:
+            raise RuntimeError('TextUtils.load_dictionaries must be called before loading "{}"'.format(filename))
+        return os.path.join(self.models_folder, filename)
+
+    def load_clause_splitter(self):
+        import rutokenizer
+        return rutokenizer.Segmenter()
+
+    def load_tokenizer(self):
+        from ruchatbot.utils.tokenizer import Tokenizer
+        tokenizer = Tokenizer()
+        tokenizer.load()
+        return tokenizer
+
+    def load_postagger(self):
+        import rupostagger
+        postagger = rupostagger.RuPosTagger()
+        postagger.load()
+        return postagger
+
+    def load_word2tags(self):
+        import ruword2tags
+        word2tags = ruword2tags.RuWord2Tags()
+        word2tags.load()
+        return word2tags
+
+    def load_parser(self):
+        # Грузим dependency parser UDPipe и русскоязычную модель
+        from ruchatbot.utils.udpipe_parser import UdpipeParser
+        parser = UdpipeParser()
+        parser.load(self.get_models_path('udpipe_syntagrus.model'))
+        return parser
 
-        self.word2tags.load()
+    def load_names(self):
+        with open(self.get_models_path('names.pkl'), 'rb') as f:
+            return set(pickle.load(f).keys())
 
-        # Грузим dependency parser UDPipe и русскоязычную модель
-        self.parser = UdpipeParser()
-        self.parser.load(os.path.join(models_folder, 'udpipe_syntagrus.model'))
+    @property
+    def clause_splitter(self):
+        return self.get_resource('clause_splitter', self.load_clause_splitter)
+
+    @property
+    def tokenizer(self):
+        return self.get_resource('tokenizer', self.load_tokenizer)
+
+    @property
+    def postagger(self):
+        return self.get_resource('postagger', self.load_postagger)
 
-        with open(os.path.join(models_folder, 'names.pkl'), 'rb') as f:
-            self.names = set(pickle.load(f).keys())
+    @property
+    def word2tags(self):
+        return self.get_resource('word2tags', self.load_word2tags)
+
+    @property
+    def parser(self):
+        return self.get_resource('parser', self.load_parser)
+
+    @property
+    def names(self):
+        return self.get_resource('names', self.load_names)
 
     def apply_word_function(self, func, constants, words):
         part_of_speech = None
@@ -82,6 +177,14 @@ class TextUtils(object):
         msg = 'Could not choose a word among {}'.format(' '.join(words))
         raise RuntimeError(msg)
 
+    def analyze(self, text):
+        """ Вернет общий для всех компонентов объект AnalyzedText для строки, анализ выполняется лениво. """
+        analysis = self.analysis_cache.get(text)
+        if analysis is None:
+            analysis = AnalyzedText(text, self)
+            self.analysis_cache.put(text, analysis)
+        return analysis
+
     def tag(self, words):
         """ Частеречная разметка для цепочки слов words """
         return self.postagger.tag(words)
@@ -135,7 +238,8 @@ class TextUtils(object):
         return parsed_data
 
     def contains_name(self, text_str) -> bool:
-        parsed_data = self.parse_syntax(text_str)
+        # Для поиска имен достаточно лемм, дерево зависимостей не нужно.
+        parsed_data = self.analyze(text_str).get_parsings()[0]
 
         up_words = [z.form.lower().replace('ё', 'е') for z in parsed_data]
         up_lemmas = [z.lemma.lower().replace('ё', 'е') for z in parsed_data]
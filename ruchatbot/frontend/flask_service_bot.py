@@ -72,6 +72,8 @@ if __name__ == '__main__':
     parser.add_argument('--profile', type=str, default=os.path.expanduser('~/polygon/chatbot/data/profile_1.json'), help='Path to yaml file with bot persona records')
     parser.add_argument('--bert', type=str)
     parser.add_argument('--db', type=str, default=':memory:', help='Connection string for SQLite storage file; use :memory: for no persistence')
+    parser.add_argument('--p2q_cache', type=str, default=None, help='File for P2Q premise pair scores, loaded at startup and saved at exit')
+    parser.add_argument('--parse_workers', type=int, default=0, help='Number of processes for parsing profile facts at startup; 0 or 1 - parse in the main process')
     parser.add_argument('--ip', type=str, default='127.0.0.1')
     parser.add_argument('--port', type=str, default='9098')
 
@@ -91,6 +93,7 @@ if __name__ == '__main__':
 
     text_utils = TextUtils()
     text_utils.load_dictionaries(data_dir, models_dir)
+    text_utils.warmup()
 
     scripting = BotScripting()
     scripting.load_resources(bot_profile, text_utils)
@@ -102,6 +105,8 @@ if __name__ == '__main__':
     #    tf.config.experimental.set_memory_growth(gpu, True)
 
     bot = BotCore()
+    bot.p2q_score_cache_path = args.p2q_cache
+    bot.parse_workers = args.parse_workers
     if args.bert is not None:
         bot.load_bert(args.bert)
     else:
@@ -112,6 +117,7 @@ if __name__ == '__main__':
             bot.load_bert(bert_name)
 
     bot.load(models_dir, text_utils)
+    bot.index_profile_facts(bot_profile)
 
     # Хранилище новых фактов, извлекаемых из диалоговых сессий.
     # По умолчанию размещается только в оперативной памяти.
@@ -28,6 +28,7 @@ class DialogRule(object):
         self.condition_keyword = None
         self.patterns = []  # list[JAICP_Pattern]
         self.actors = []
+        self.need_syntax = True  # нужен ли паттернам синтаксический разбор реплик, или хватит морфологии
 
     def __repr__(self):
         if self.name:
@@ -76,6 +77,8 @@ class DialogRule(object):
         else:
             raise NotImplementedError()
 
+        rule.need_syntax = any(pattern.needs_syntax() for _, pattern in rule.patterns)
+
         if isinstance(yaml_node['rule']['then'], dict):
             actor = ActorBase.load_from_yaml(yaml_node['rule']['then'], constants, generative_named_patterns, text_utils)
             rule.actors.append(actor)
@@ -102,13 +105,16 @@ class DialogRule(object):
             # оставим сопоставление с максимальным скором.
             for utterance_text in [utterance.get_text(), utterance.get_interpretation()]:
                 if utterance_text:
-                    if utterance_text in parsing_cache:
-                        parsing = parsing_cache[utterance_text]
-                    else:
-                        utterance_parsings = text_utils.parser.parse_text(utterance_text)
+                    # в parsing_cache полный разбор хранится по тексту, разбор без синтаксиса - по паре (текст, False)
+                    parsing = parsing_cache.get(utterance_text)
+                    if parsing is None and not self.need_syntax:
+                        parsing = parsing_cache.get((utterance_text, False))
+
+                    if parsing is None:
+                        utterance_parsings = text_utils.parser.parse_text(utterance_text, need_syntax=self.need_syntax)
                         #parsing = Parsing(tokens=itertools.chain(*utterance_parsings), text=utterance_text)
                         parsing = ParsingResult(tokens=itertools.chain(*utterance_parsings), text=utterance_text)
-                        parsing_cache[utterance_text] = parsing
+                        parsing_cache[utterance_text if self.need_syntax else (utterance_text, False)] = parsing
 
                     matching, score = pattern.match(parsing, matching_cache)
                     if matching is not None and score > 0.0 and score > best_score:
@@ -81,6 +81,12 @@ class JAICP_Pattern:
         #self.start_node = self.start_node.optimize()
         pass
 
+    def needs_syntax(self):
+        """ Паттерну нужно дерево зависимостей, только если в нем есть составляющие ⟦...⟧ """
+        all_nodes = []
+        self.start_node.list_all_nodes(all_nodes)
+        return any(isinstance(n, JAICP_Constituent) for n in all_nodes)
+
     @staticmethod
     def build_next_node(tokens, token, named_patterns):
         if token == '*' or token.startswith('*{'):
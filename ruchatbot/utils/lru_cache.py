@@ -0,0 +1,65 @@
+"""
+Потокобезопасный LRU-кэш с ограничением на количество элементов и счетчиками попаданий/промахов.
+"""
+
+import collections
+import threading
+
+
+class LruCache(object):
+    def __init__(self, max_size=10000):
+        """
+        :param max_size: максимальное количество элементов, 0 - кэш отключен
+        """
+        self.max_size = max_size
+        self.key2value = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None, accept=None):
+        """
+        :param accept: необязательная проверка найденного значения; если она вернула False,
+                       значение считается отсутствующим, и это учитывается как промах
+        """
+        with self.lock:
+            value = self.key2value.get(key, self)
+            if value is self or (accept is not None and not accept(value)):
+                self.misses += 1
+                return default
+
+            self.key2value.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+
+        with self.lock:
+            self.key2value[key] = value
+            self.key2value.move_to_end(key)
+            while len(self.key2value) > self.max_size:
+                self.key2value.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.key2value.pop(key, default)
+
+    def clear(self):
+        with self.lock:
+            self.key2value.clear()
+
+    def items(self):
+        with self.lock:
+            return list(self.key2value.items())
+
+    def get_hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def __contains__(self, key):
+        return key in self.key2value
+
+    def __len__(self):
+        return len(self.key2value)
@@ -1,10 +1,32 @@
+"""
+Обертка для синтаксического парсера UDPipe.
+
+19.10.2026 Токены читаются напрямую из объектов Sentence/Word библиотеки ufal.udpipe, без сериализации в CoNLL-U
+           и повторного разбора через pyconll (старый путь оставлен в parse_text_conllu для сверки).
+19.10.2026 Общий для всех компонентов бота LRU-кэш результатов парсинга по тексту.
+19.10.2026 Пакетный парсинг parse_many в пуле процессов для предобработки больших наборов фактов и правил.
+19.10.2026 parse_batch - парсинг нескольких текстов за один проход с общим токенизатором, который
+           сбрасывается на каждом тексте, так что результат не зависит от состава пакета.
+19.10.2026 Режим need_syntax=False - только токенизация и морфология, без построения дерева зависимостей.
+19.10.2026 UDPipeToken со __slots__, морфологические признаки хранятся в разделяемом словаре, get_attr за O(1).
+"""
+
+import multiprocessing
 import os
+import sys
+import time
 
 import pyconll
-from ufal.udpipe import Model, Pipeline, ProcessingError
+from ufal.udpipe import Model, Pipeline, ProcessingError, Sentence
+
+from ruchatbot.utils.lru_cache import LruCache
 
 
 class UDPipeToken:
+    # Токенов в кэшах парсера много, поэтому без __dict__, а морфологические признаки хранятся
+    # в словаре признак => значение, общем для всех токенов с одинаковым набором тегов. Словарь не модифицируется.
+    __slots__ = ('id', 'form', 'upos', 'lemma', 'feats', 'deprel', 'head')
+
     def __init__(self, ud_token, upos=None, tags=None):
         self.id = ud_token.id
         self.form = ud_token.form
@@ -14,15 +36,76 @@ class UDPipeToken:
         self.deprel = ud_token.deprel
         self.head = ud_token.head
 
+    @property
+    def tags(self):
+        """Список тегов в виде строк "Case=Nom" """
+        return [(k + '=' + v) for k, v in self.feats.items()]
+
+    @tags.setter
+    def tags(self, tags):
+        self.feats = intern_feats('|'.join(tags))
+
+    @staticmethod
+    def from_udpipe_word(word, upos=None, tags=None):
+        """Токен из объекта ufal.udpipe.Word, поля заполняются так же, как при чтении CoNLL-U через pyconll."""
+        token = UDPipeToken.__new__(UDPipeToken)
+        token.id = str(word.id)
+        token.form = word.form
+        token.upos = none_if_empty(word.upostag) if upos is None else upos
+        token.lemma = none_if_empty(word.lemma)
+        token.feats = intern_feats(word.feats) if tags is None else intern_feats('|'.join(tags))
+        token.deprel = none_if_empty(word.deprel)
+        token.head = str(word.head) if word.head >= 0 else None
+        return token
+
+    def copy(self, upos, tags):
+        token = UDPipeToken.__new__(UDPipeToken)
+        token.id = self.id
+        token.form = self.form
+        token.upos = upos
+        token.lemma = self.lemma
+        token.tags = tags
+        token.deprel = self.deprel
+        token.head = self.head
+        return token
+
+    def to_tuple(self):
+        return (self.id, self.form, self.upos, self.lemma, tuple(self.tags), self.deprel, self.head)
+
+    @staticmethod
+    def from_tuple(t):
+        token = UDPipeToken.__new__(UDPipeToken)
+        token.id, token.form, token.upos, token.lemma, tags, token.deprel, token.head = t
+        token.tags = tags
+        return token
+
     def __repr__(self):
         return self.form
 
     def get_attr(self, attr_name):
-        k = attr_name + '='
-        for t in self.tags:
-            if t.startswith(k):
-                return t.split('=')[1]
-        return ''
+        return self.feats.get(attr_name, '')
+
+
+def none_if_empty(value):
+    return None if value in ('', '_') else value
+
+
+# Строка признаков "Case=Nom|Gender=Fem" => разделяемый словарь признаков.
+# Различных наборов признаков немного, поэтому таблица не ограничивается по размеру.
+feats_table = dict()
+
+
+def intern_feats(feats_str):
+    feats = feats_table.get(feats_str)
+    if feats is None:
+        feats = dict()
+        if feats_str not in ('', '_'):
+            # для множественных значений "Case=Acc,Nom" берем первое
+            for feat in feats_str.split('|'):
+                k, v = feat.split('=', 1)
+                feats[sys.intern(k)] = sys.intern(v.split(',')[0])
+        feats_table[feats_str] = feats
+    return feats
 
 
 def get_attr(token, tag_name):
@@ -53,12 +136,28 @@ class Parsing(object):
     def __getitem__(self, i):
         return self.tokens[int(i)-1]
 
+    def to_tuple(self):
+        return (self.text, tuple(t.to_tuple() for t in self.tokens))
+
+    @staticmethod
+    def from_tuple(t):
+        text, tokens = t
+        return Parsing([UDPipeToken.from_tuple(token) for token in tokens], text)
+
 
 class UdpipeParser:
-    def __init__(self):
+    def __init__(self, cache_size=20000):
+        """
+        :param cache_size: сколько текстов хранить в кэше результатов парсинга, 0 - кэш отключен
+        """
         self.model = None
+        self.model_path = None
         self.pipeline = None
         self.error = None
+        # Одни и те же реплики парсятся на каждом ходе в правилах, при поиске лемм, имен и т.д.
+        # Результаты парсинга никто не модифицирует, поэтому их можно безопасно разделять.
+        self.parse_cache = LruCache(max_size=cache_size)
+        self.morph_cache = LruCache(max_size=cache_size)  # результаты без синтаксиса (need_syntax=False)
 
     def load(self, model_path):
         if os.path.isfile(model_path):
@@ -67,10 +166,147 @@ class UdpipeParser:
             udp_model_file = os.path.join(model_path, 'udpipe_syntagrus.model')
 
         self.model = Model.load(udp_model_file)
+        self.model_path = udp_model_file
         self.pipeline = Pipeline(self.model, 'tokenize', Pipeline.DEFAULT, Pipeline.DEFAULT, 'conllu')
         self.error = ProcessingError()
 
-    def parse_text(self, text):
+    def parse_text(self, text, need_syntax=True):
+        """
+        Вернет список разборов предложений текста.
+        need_syntax=False - нужны только леммы и морфологические теги, дерево зависимостей не строится,
+        поля head и deprel у токенов будут пустыми.
+        """
+        parsings = self.get_cached(text, need_syntax)
+        if parsings is None:
+            parsings = self.parse_text_nocache(text, need_syntax)
+            if parsings is None:
+                return None
+            self.put_cached(text, need_syntax, parsings)
+        return list(parsings)
+
+    def get_cached(self, text, need_syntax):
+        # полный разбор подходит и тем, кому нужна только морфология
+        parsings = self.parse_cache.get(text)
+        if parsings is None and not need_syntax:
+            parsings = self.morph_cache.get(text)
+        return parsings
+
+    def put_cached(self, text, need_syntax, parsings):
+        if need_syntax:
+            self.parse_cache.put(text, parsings)
+        else:
+            self.morph_cache.put(text, parsings)
+
+    def parse_batch(self, texts, need_syntax=True):
+        """
+        Парсинг нескольких текстов за один проход с общим токенизатором. Тексты не склеиваются в один документ:
+        состояние токенизатора UDPipe переходит через границу абзаца, и токенизация текста тогда зависела бы
+        от предыдущего текста в пакете. Вместо этого токенизатор получает каждый текст заново через setText.
+        Вернет список результатов в порядке texts, как если бы для каждого текста вызывался parse_text.
+        """
+        results = [self.get_cached(text, need_syntax) for text in texts]
+        new_texts = list(set(text for text, result in zip(texts, results) if result is None))
+        if len(new_texts) == 1:
+            self.parse_text(new_texts[0], need_syntax)
+        elif new_texts:
+            for text, parsings in zip(new_texts, self.parse_document(new_texts, need_syntax)):
+                if parsings is not None:
+                    self.put_cached(text, need_syntax, parsings)
+
+        return [(list(result) if result is not None else self.parse_text(text, need_syntax)) for text, result in zip(texts, results)]
+
+    def parse_document(self, texts, need_syntax=True):
+        """Разбор текстов одним токенизатором, вернет для каждого текста список Parsing или None при ошибке."""
+        tokenizer = self.model.newTokenizer(Model.DEFAULT)
+        if tokenizer is None:
+            return [None] * len(texts)
+
+        results = []
+        for text in texts:
+            tokenizer.setText(text)
+            parsings = []
+            sentence = Sentence()
+            try:
+                while tokenizer.nextSentence(sentence, self.error):
+                    self.model.tag(sentence, Model.DEFAULT, self.error)
+                    if need_syntax:
+                        self.model.parse(sentence, Model.DEFAULT, self.error)
+                    if self.error.occurred():
+                        break
+
+                    tokens0 = [UDPipeToken.from_udpipe_word(word) for word in list(sentence.words)[1:]]
+                    parsings.append(Parsing(fix_tokens(tokens0), sentence.getText()))
+                    sentence = Sentence()
+            except:
+                parsings = None
+
+            if self.error.occurred():
+                # Сбрасываем ошибку, чтобы она не помешала разбору остальных текстов.
+                self.error = ProcessingError()
+                parsings = None
+
+            results.append(parsings)
+
+        return results
+
+    def parse_many(self, texts, workers=4, fill_cache=True, need_syntax=True):
+        """
+        Парсинг большого списка текстов в пуле из workers процессов, каждый процесс загружает свою модель UDPipe.
+        Вернет в порядке входных текстов результаты в компактном виде: для каждого текста кортеж
+        разборов предложений Parsing.to_tuple() или None, если текст не удалось разобрать.
+        При fill_cache=True результаты кладутся в кэш, и последующие вызовы parse_text для этих текстов не парсят.
+        """
+        texts = list(texts)
+        if workers <= 1 or len(texts) < workers * 2:
+            results = [parsing_to_tuple(self.parse_text_nocache(text, need_syntax)) for text in texts]
+        else:
+            ctx = multiprocessing.get_context('spawn')
+            chunksize = max(1, len(texts) // (workers * 4))
+            with ctx.Pool(processes=workers, initializer=init_worker_parser, initargs=(self.model_path, need_syntax)) as pool:
+                results = pool.map(worker_parse_text, texts, chunksize=chunksize)
+
+        if fill_cache:
+            for text, result in zip(texts, results):
+                if result is not None:
+                    self.put_cached(text, need_syntax, [Parsing.from_tuple(t) for t in result])
+
+        return results
+
+    def get_cache_stats(self):
+        return 'parse cache: size={} hits={} misses={} hit_rate={:.3f}; morph cache: size={} hits={} misses={} hit_rate={:.3f}'.format(
+            len(self.parse_cache), self.parse_cache.hits, self.parse_cache.misses, self.parse_cache.get_hit_rate(),
+            len(self.morph_cache), self.morph_cache.hits, self.morph_cache.misses, self.morph_cache.get_hit_rate())
+
+    def parse_text_nocache(self, text, need_syntax=True):
+        parsings = []
+
+        tokenizer = self.model.newTokenizer(Model.DEFAULT)
+        if tokenizer is None:
+            return None
+        tokenizer.setText(text)
+        sentence = Sentence()
+        try:
+            while tokenizer.nextSentence(sentence, self.error):
+                self.model.tag(sentence, Model.DEFAULT, self.error)
+                if need_syntax:
+                    self.model.parse(sentence, Model.DEFAULT, self.error)
+                if self.error.occurred():
+                    return None
+
+                # sentence.words[0] - технический корневой узел
+                tokens0 = [UDPipeToken.from_udpipe_word(word) for word in list(sentence.words)[1:]]
+                parsings.append(Parsing(fix_tokens(tokens0), sentence.getText()))
+                sentence = Sentence()
+
+            if self.error.occurred():
+                return None
+        except:
+            return None
+
+        return parsings
+
+    def parse_text_conllu(self, text):
+        """Старый путь разбора: CoNLL-U текст от пайплайна UDPipe читается через pyconll."""
         parsings = []
 
         processed = self.pipeline.process(text, self.error)
@@ -110,12 +346,136 @@ class UdpipeParser:
         return parsings
 
 
+def parsing_to_tuple(parsings):
+    if parsings is None:
+        return None
+    return tuple(parsing.to_tuple() for parsing in parsings)
+
+
+# Экземпляр парсера в рабочем процессе пула parse_many
+worker_parser = None
+worker_need_syntax = True
+
+
+def init_worker_parser(model_path, need_syntax):
+    global worker_parser, worker_need_syntax
+    worker_parser = UdpipeParser(cache_size=0)
+    worker_parser.load(model_path)
+    worker_need_syntax = need_syntax
+
+
+def worker_parse_text(text):
+    return parsing_to_tuple(worker_parser.parse_text_nocache(text, worker_need_syntax))
+
+
+def fix_tokens(tokens0):
+    """
+    24-12-2021 Руками исправляем некоторые очень частотные ошибки разметки UDPipe.Syntagrus.
+    Соседние токены проверяются в исходной, неисправленной разметке.
+    """
+    tokens = []
+    for itoken, token in enumerate(tokens0):
+        utoken = token.form.lower()
+
+        if utoken == 'душе':
+            is_soul_dative = False
+            if token.id == '1':
+                is_soul_dative = True
+            else:
+                for neighb_token in tokens0[itoken-1: itoken+2]:
+                    if neighb_token.upos in ('ADJ', 'DET') and neighb_token.get_attr('Gender') == 'Fem':
+                        is_soul_dative = True
+                        break
+
+            if is_soul_dative:
+                tokens.append(token.copy(upos='NOUN', tags=['Case=Dat']))
+                continue
+
+        if utoken in ['чтоб']:
+            tokens.append(token.copy(upos='SCONJ', tags=[]))
+        elif utoken in ['средь']:
+            tokens.append(token.copy(upos='ADP', tags=[]))
+        else:
+            tokens.append(token)
+    return tokens
+
+
 if __name__ == '__main__':
+    # Проверки и замеры на настоящей модели UDPipe:
+    #   python -m ruchatbot.utils.udpipe_parser <каталог с udpipe_syntagrus.model или путь к файлу модели>
+    # Вместо аргумента можно задать каталог моделей в переменной окружения RUCHATBOT_MODELS.
+    model_path = sys.argv[1] if len(sys.argv) > 1 else os.environ.get('RUCHATBOT_MODELS')
+    if model_path is None:
+        print('Usage: python -m ruchatbot.utils.udpipe_parser <models_dir | udpipe_syntagrus.model>, or set RUCHATBOT_MODELS')
+        exit(1)
+
     parser = UdpipeParser()
-    parser.load('/home/inkoziev/polygon/text_generator/models')
+    parser.load(model_path)
+    if parser.model is None:
+        print('Could not load UDPipe model from "{}"'.format(model_path))
+        exit(1)
 
     parsing = parser.parse_text('Твоей душе испорченной')[0]
     for token in parsing:
         print('{} {} {}'.format(token.form, token.upos, token.tags))
 
+    # Сверка прямого чтения токенов из ufal.udpipe со старым путем через CoNLL-U и pyconll.
+    texts = ['Твоей душе испорченной', 'Душе не прикажешь.', 'Чтоб ты знал, средь бела дня!',
+             'Привет, как дела? Меня зовут Вика.', 'Кошка ловит мышей в темном подвале, а собака спит.']
+    fields = ('id', 'form', 'upos', 'lemma', 'tags', 'deprel', 'head')
+    for text in texts:
+        parsings1 = parser.parse_text_nocache(text)
+        parsings2 = parser.parse_text_conllu(text)
+        assert len(parsings1) == len(parsings2), text
+        for p1, p2 in zip(parsings1, parsings2):
+            assert p1.get_text() == p2.get_text(), (p1.get_text(), p2.get_text())
+            for t1, t2 in zip(p1, p2):
+                for field in fields:
+                    assert getattr(t1, field) == getattr(t2, field), (text, t1.form, field, getattr(t1, field), getattr(t2, field))
+    print('Parity check passed')
+
+    for text, parsings1 in zip(texts, parser.parse_batch(texts)):
+        parsings2 = parser.parse_text_nocache(text)
+        assert [p.get_text() for p in parsings1] == [p.get_text() for p in parsings2], text
+        for p1, p2 in zip(parsings1, parsings2):
+            assert [t.to_tuple() for t in p1] == [t.to_tuple() for t in p2], text
+    print('Batch parsing check passed')
+
+    # Пропускная способность обоих путей.
+    nb_repeats = 200
+    for name, parse_fn in [('conllu+pyconll', parser.parse_text_conllu), ('direct', parser.parse_text_nocache), ('cached', parser.parse_text)]:
+        t0 = time.time()
+        for _ in range(nb_repeats):
+            for text in texts:
+                parse_fn(text)
+        elapsed = time.time() - t0
+        print('{:<16} {:8.1f} texts/sec'.format(name, nb_repeats * len(texts) / elapsed))
+
+    # Память и скорость get_attr для токенов со __slots__ в сравнении с прежним представлением (список строк тегов).
+    import tracemalloc
+
+    class ListTagsToken(object):
+        def __init__(self, t):
+            self.id, self.form, self.upos, self.lemma, tags, self.deprel, self.head = t
+            self.tags = list(tags)
+
+        def get_attr(self, attr_name):
+            k = attr_name + '='
+            for t in self.tags:
+                if t.startswith(k):
+                    return t.split('=')[1]
+            return ''
+
+    token_tuples = [t.to_tuple() for text in texts for p in parser.parse_text(text) for t in p] * 2000
+    for name, token_class in [('list of tags', ListTagsToken), ('slots+feats', UDPipeToken.from_tuple)]:
+        tracemalloc.start()
+        tokens = [token_class(t) for t in token_tuples]
+        mem_size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
 
+        t0 = time.time()
+        for token in tokens:
+            for tag_name in ('Case', 'Number', 'Gender', 'Tense', 'VerbForm'):
+                token.get_attr(tag_name)
+        elapsed = time.time() - t0
+        print('{:<14} {:7.1f} bytes/token  {:8.3f} sec for {} get_attr calls'.format(name, mem_size / len(tokens), elapsed, len(tokens) * 5))